@@ -0,0 +1,182 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# checkm2 predicts all bins in one run, bakta and prokka annotate one bin per task
+BIN_TOOLS = ("checkm2", "bakta", "prokka")
+
+
+class BinAnnotationQueue:
+    """
+    Work queue that annotates the bins of a sample concurrently under a cpu budget. Every (tool, bin) pair is a
+    task with cpus_per_bin cpus, checkm2 runs once for the whole bins directory next to them. The status of every
+    task and the size/mtime of its bin are stored in bin_annotation_status.json, a rerun only runs tasks that failed,
+    were never run or whose bin changed, records of bins that are no longer in bins_dir are dropped. Every run
+    rewrites the keggcharter input with the prokka results of the current bins annotated earlier and extends it
+    with the prokka result of every bin as soon as the bin is annotated.
+    """
+
+    def __init__(self, functional_runner, bins_dir, out_path, cpus_per_bin=4, tools=BIN_TOOLS):
+        self.runner = functional_runner
+        self.bins_dir = bins_dir
+        self.cpus_per_bin = cpus_per_bin
+        self.tools = tools
+        self.status_file = os.path.join(out_path, "bin_annotation_status.json")
+        self.checkm2_report = os.path.join(out_path, "checkm2_results", "quality_report.tsv")
+        self.bakta_dir = os.path.join(out_path, "bakta_results")
+        self.prokka_dir = os.path.join(out_path, "prokka_results")
+        self.keggcharter_tsv = os.path.join(self.prokka_dir, "keggcharter.tsv")
+        self.out_path = out_path
+
+    def load_status(self):
+        if not os.path.exists(self.status_file):
+            return {}
+        with open(self.status_file) as infile:
+            return json.load(infile)
+
+    def save_status(self, status):
+        tmp_file = f"{self.status_file}.tmp"
+        with open(tmp_file, 'w') as outfile:
+            json.dump(status, outfile, indent=1)
+        os.replace(tmp_file, self.status_file)
+
+    @staticmethod
+    def fingerprint(bin_files):
+        return [[os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in bin_files]
+
+    def tasks(self, bin_files):
+        """
+        return: list of (task name, tool, bin file or None for checkm2, fingerprint)
+        """
+        tasks = []
+        if "checkm2" in self.tools and bin_files:
+            tasks.append(("checkm2", "checkm2", None, self.fingerprint(bin_files)))
+        for bin_file in bin_files:
+            bin_name = self.runner.bin_name(bin_file)
+            for tool in ("prokka", "bakta"):
+                if tool in self.tools:
+                    tasks.append((f"{tool}/{bin_name}", tool, bin_file, self.fingerprint([bin_file])))
+        return tasks
+
+    @staticmethod
+    def remove_stale(report):
+        """
+        Removes the report of an earlier run, checkm2 and bakta only print their errors, so a report that exists
+        after the run is only trusted if the run wrote it.
+        """
+        if os.path.exists(report):
+            os.remove(report)
+
+    def run_task(self, tool, bin_file, cpus):
+        """
+        return: True if the tool produced its output
+        """
+        if tool == "checkm2":
+            self.remove_stale(self.checkm2_report)
+            self.runner.run_checkm2(self.bins_dir, self.out_path, cpus=cpus)
+            return os.path.exists(self.checkm2_report)
+        bin_name = self.runner.bin_name(bin_file)
+        if tool == "bakta":
+            output_dir = os.path.join(self.bakta_dir, bin_name)
+            bakta_tsv = os.path.join(output_dir, f"{bin_name}.tsv")
+            self.remove_stale(bakta_tsv)
+            self.runner.run_bakta(bin_file, output_dir, cpus=cpus)
+            return os.path.exists(bakta_tsv)
+        prokka_tsv = self.runner.run_prokka_bin(bin_file, os.path.join(self.prokka_dir, bin_name), cpus=cpus)
+        return prokka_tsv is not None and os.path.exists(prokka_tsv)
+
+    def run(self, cpus=None):
+        """
+        Runs all tasks that are not done yet, at most cpus cpus are used at the same time.
+        return: list of failed task names
+        """
+        cpus = cpus or multiprocessing.cpu_count()
+        cpus_per_bin = max(1, min(self.cpus_per_bin, cpus))
+        bin_files = self.runner.bin_files(self.bins_dir)
+        status = self.load_status()
+        self.remove_missing_bins(bin_files, status)
+        os.makedirs(self.prokka_dir, exist_ok=True)
+        # also written without bins, the keggcharter input is the output of the annotation step
+        self.runner.write_keggcharter_input(self.keggcharter_tsv, self.prokka_results(bin_files, status))
+
+        tasks = self.tasks(bin_files)
+        pending, failed = [], []
+        for name, tool, bin_file, fingerprint in tasks:
+            record = status.get(name)
+            if record is not None and record["status"] == "done" and record["fingerprint"] == fingerprint:
+                continue
+            # checkm2 processes all bins with half of the budget, the bins share the rest
+            task_cpus = max(cpus_per_bin, cpus // 2) if tool == "checkm2" else cpus_per_bin
+            pending.append((name, tool, bin_file, fingerprint, min(task_cpus, cpus)))
+        print(f"Annotating {len(bin_files)} bins: {len(pending)} tasks to run, "
+              f"{len(tasks) - len(pending)} done in earlier runs")
+        n_pending = len(pending)
+
+        running = {}
+        free_cpus = cpus
+        with ThreadPoolExecutor(max_workers=max(1, cpus)) as pool:
+            while pending or running:
+                while pending and pending[0][4] <= free_cpus:
+                    name, tool, bin_file, fingerprint, task_cpus = pending.pop(0)
+                    free_cpus -= task_cpus
+                    running[pool.submit(self.run_task, tool, bin_file, task_cpus)] = (name, tool, bin_file,
+                                                                                      fingerprint, task_cpus)
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, tool, bin_file, fingerprint, task_cpus = running.pop(future)
+                    free_cpus += task_cpus
+                    try:
+                        succeeded = future.result()
+                    except Exception as e:
+                        print(f"Annotation task {name} failed: {e}")
+                        succeeded = False
+                    if succeeded and tool == "prokka":
+                        self.merge_prokka_result(bin_file)
+                    if not succeeded:
+                        failed.append(name)
+                    status[name] = {"status": "done" if succeeded else "failed", "fingerprint": fingerprint,
+                                    "bin": os.path.basename(bin_file) if bin_file else None}
+                    self.save_status(status)
+                    print(f"Annotation task {name} {'done' if succeeded else 'failed'} "
+                          f"({n_pending - len(pending) - len(running)} of {n_pending})")
+        return failed
+
+    def remove_missing_bins(self, bin_files, status):
+        """
+        Drops the status records of bins that are no longer in bins_dir (e.g. after gtdb-tk renamed them), without
+        bins the checkm2 record and report are dropped as well.
+        """
+        current = {os.path.basename(f) for f in bin_files}
+        missing = []
+        for name, record in status.items():
+            # the checkm2 task has no bin of its own, it covers all bins
+            if (record.get("bin") is None and not bin_files) or \
+                    (record.get("bin") is not None and record["bin"] not in current):
+                missing.append(name)
+        for name in missing:
+            del status[name]
+        if not bin_files:
+            self.remove_stale(self.checkm2_report)
+        if missing:
+            print(f"Dropping annotation status of {len(missing)} tasks of bins that no longer exist")
+            self.save_status(status)
+
+    def prokka_results(self, bin_files, status):
+        """
+        return: list of (prokka tsv, bin name) of the bins in bin_files that were annotated with prokka before
+        """
+        results = []
+        for bin_file in bin_files:
+            bin_name = self.runner.bin_name(bin_file)
+            record = status.get(f"prokka/{bin_name}")
+            prokka_tsv = os.path.join(self.prokka_dir, bin_name, f"{bin_name}.tsv")
+            if record is not None and record["status"] == "done" and os.path.exists(prokka_tsv):
+                results.append((prokka_tsv, bin_name))
+        return results
+
+    def merge_prokka_result(self, bin_file):
+        bin_name = self.runner.bin_name(bin_file)
+        prokka_tsv = os.path.join(self.prokka_dir, bin_name, f"{bin_name}.tsv")
+        if os.path.exists(prokka_tsv):
+            self.runner.append_keggcharter_input(self.keggcharter_tsv, prokka_tsv, bin_name)
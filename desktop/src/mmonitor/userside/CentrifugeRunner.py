@@ -4,6 +4,8 @@ import multiprocessing
 import os
 import subprocess
 from build_mmonitor_pyinstaller import ROOT
+from src.mmonitor.userside.SequenceInput import SequenceInput
+from src.mmonitor.userside.StageCache import StageCache
 from Bio import SeqIO
 from concurrent.futures import ThreadPoolExecutor
 import concurrent
@@ -31,6 +33,12 @@ class CentrifugeRunner:
         self.check_centrifuge()
         self.cent_out = ""
         self.concat_file_name = ""
+        # how the chunk files of a sample are passed to centrifuge, see SequenceInput.MODES
+        self.input_mode = "files"
+        # collect QC statistics while the reads are streamed to centrifuge (see SequenceInput.ingest)
+        self.collect_qc = False
+        self.qc_statistics = None
+        self.stage_cache = StageCache()
 
     @staticmethod
     def concatenate_files_in_memory(file_paths):
@@ -100,9 +108,18 @@ class CentrifugeRunner:
 
     @staticmethod
     def make_kraken_report(centrifuge_index_path, cent_out):
-        cmd = f"centrifuge-kreport -x {centrifuge_index_path} {cent_out} > {cent_out.replace('cent_out', 'kraken_out')}"
+        """
+        return: True if centrifuge-kreport succeeded, a failed report is removed
+        """
+        kraken_out = cent_out.replace('cent_out', 'kraken_out')
+        cmd = f"centrifuge-kreport -x {centrifuge_index_path} {cent_out} > {kraken_out}"
         print(cmd)
-        os.system(cmd)
+        if os.system(cmd) != 0:
+            print(f"Error executing centrifuge-kreport for {cent_out}")
+            if os.path.exists(kraken_out):
+                os.remove(kraken_out)
+            return False
+        return True
 
     @staticmethod
     def process_line(line, centrifuge_index_path):
@@ -112,7 +129,10 @@ class CentrifugeRunner:
         col_path, output_file = columns[3], columns[4]
         cmd = ["centrifuge-kreport", "-x", centrifuge_index_path, col_path]
         with open(output_file, 'w') as output:
-            subprocess.run(cmd, stdout=output, stderr=subprocess.DEVNULL)
+            result = subprocess.run(cmd, stdout=output, stderr=subprocess.DEVNULL)
+        if result.returncode != 0:
+            print(f"Error executing centrifuge-kreport for {col_path}")
+            os.remove(output_file)
 
     @staticmethod
     def make_kraken_report_from_tsv(file_path, centrifuge_index_path, max_workers=64):
@@ -122,8 +142,14 @@ class CentrifugeRunner:
 
     @staticmethod
     def run_centrifuge_multi_sample(centrifuge_tsv_path, database_path):
+        """
+        return: True if centrifuge succeeded
+        """
         cmd = f'centrifuge -x "{database_path}" --sample-sheet {centrifuge_tsv_path} -p {multiprocessing.cpu_count()}'
-        os.system(cmd)
+        if os.system(cmd) != 0:
+            print(f"Error executing centrifuge for the samples in {centrifuge_tsv_path}")
+            return False
+        return True
 
     @staticmethod
     def create_centrifuge_input_file(sample_names, concat_file_names, output_tsv_file):
@@ -131,7 +157,7 @@ class CentrifugeRunner:
         Creates a TSV file for running centrifuge in multi sample mode.
 
         :param sample_names: List of sample names.
-        :param concat_file_name: The concatenated file name for read-file1.
+        :param concat_file_names: The read file of every sample (fifo or concatenated file) for read-file1.
         :param output_tsv_file: The path to the output TSV file.
         """
         with open(output_tsv_file, 'w') as file:
@@ -160,25 +186,52 @@ class CentrifugeRunner:
             self.logger.error(
                 "Make sure that centrifuge is installed and on the sytem path. For more info visit http://www.ccb.jhu.edu/software/centrifuge/manual.shtml")
 
-    def run_centrifuge(self, concat_file_path,sample_name,database_path):
-        # print(sequence_list)
-        #remove concatenated files from sequence list to avoid concatenating twice
-        # sequence_list = [s for s in sequence_list if "concatenated" not in s]
-        # concat_file_name = f"{os.path.dirname(sequence_list[0])}/{sample_name}_concatenated.fastq.gz"
-        self.concat_file_name = concat_file_path
-        print(concat_file_path)
+    def run_centrifuge(self, sequence_files, sample_name, database_path):
+        """
+        Runs centrifuge on the sequencing files of a sample. sequence_files is a single file or a list of chunk
+        files, they are passed to centrifuge -U as comma separated list (or as fifo/concatenated file, depending on
+        self.input_mode, see SequenceInput) so no concatenated copy of the reads is written by default. The
+        classification and kraken report are reused from self.stage_cache if reads and database are unchanged.
+        """
+        if isinstance(sequence_files, str):
+            sequence_files = [sequence_files]
+        # QC statistics are calculated from the chunk files directly, unless they are collected during classification
+        self.concat_file_name = sequence_files
+        self.qc_statistics = None
         self.cent_out = f"{ROOT}/src/resources/pipeline_out/{sample_name}_cent_out"
 
-        # self.concatenate_fastq_files(sequence_list,concat_file_name)
-        # self.concatenate_fastq_parallel(sequence_list, concat_file_name)
-
-        if concat_file_path.lower().endswith(('.fq', '.fastq', '.fastq.gz', '.fq.gz')):
-            cmd = f'centrifuge -x "{database_path}" -U {concat_file_path} -p {multiprocessing.cpu_count()} -S {self.cent_out}'
-            print(cmd)
-            os.system(cmd)
-            self.make_kraken_report(database_path, self.cent_out)
+        if sequence_files[0].lower().endswith(('.fq', '.fastq', '.fastq.gz', '.fq.gz')):
+            cache_key = self.centrifuge_cache_key(sequence_files, database_path)
+            cache_outputs = self.centrifuge_outputs(sample_name)
+            if self.stage_cache.restore("centrifuge", cache_key, cache_outputs, f"{sample_name} "):
+                return
+            with SequenceInput(sequence_files, sample_name, self.input_mode, collect_qc=self.collect_qc) as reads:
+                with reads.as_files(separator=",") as read_arg:
+                    cmd = f'centrifuge -x "{database_path}" -U {read_arg} -p {multiprocessing.cpu_count()} -S {self.cent_out}'
+                    print(cmd)
+                    status = os.system(cmd)
+                self.qc_statistics = reads.qc_statistics
+            if status != 0:
+                print(f"Error executing centrifuge for sample {sample_name}")
+                return
+            if self.make_kraken_report(database_path, self.cent_out):
+                self.stage_cache.store("centrifuge", cache_key, cache_outputs)
             return
 
+    def centrifuge_cache_key(self, sequence_files, database_path):
+        """
+        Stage cache key of the centrifuge classification and kraken report of a sample.
+        """
+        return self.stage_cache.key("centrifuge", sequence_files, [f"{database_path}.*.cf"], {"report": "kreport"})
+
+    @staticmethod
+    def centrifuge_outputs(sample_name):
+        """
+        Classification and kraken report written for a sample by run_centrifuge and the multi sample mode.
+        """
+        return {"cent_out": f"{ROOT}/src/resources/pipeline_out/{sample_name}_cent_out",
+                "kraken_out": f"{ROOT}/src/resources/pipeline_out/{sample_name}_kraken_out"}
+
     def get_files_from_folder(self, folder_path):
         """
         Gets a path to a folder, checks if path contains sequencing files with specified endings and returns list
@@ -1,13 +1,14 @@
-import gzip
 import logging
 import multiprocessing
 import os
 import subprocess
-
-import pandas as pd
+from contextlib import nullcontext
 
 from build_mmonitor_pyinstaller import ROOT
 from lib import emu
+from src.mmonitor.userside.FastqConcatenator import FastqConcatenator
+from src.mmonitor.userside.SequenceInput import SequenceInput
+from src.mmonitor.userside.StageCache import StageCache
 
 
 class EmuRunner:
@@ -17,6 +18,13 @@ class EmuRunner:
         self.logger = logging.getLogger('timestamp')
         self.check_emu()
         self.emu_out = ""
+        self.emu_db = "/home/minion-computer/emu_db/latest/silva"
+        # how the chunk files of a sample are passed to minimap2, see SequenceInput.MODES
+        self.input_mode = "files"
+        # collect QC statistics while the reads are streamed to minimap2 (see SequenceInput.ingest)
+        self.collect_qc = False
+        self.qc_statistics = None
+        self.stage_cache = StageCache()
 
     @staticmethod
     def unpack_fastq_list(ls):
@@ -36,19 +44,34 @@ class EmuRunner:
             self.logger.error(
                 "Make sure that emu.py is installed and on the sytem path. For more info visit http://www.ccb.jhu.edu/software/centrifuge/manual.shtml")
 
-    def run_emu(self, sequence_list, sample_name, min_abundance):
+    def run_emu(self, sequence_list, sample_name, min_abundance, stream_alignments=True, threads=None,
+                align_slot=None, eq_class_tolerance=None, em_scheme="squarem", prune_margin=None,
+                prune_report=False, em_shards=1):
+        """
+        threads is the number of minimap2 threads (all cores by default). align_slot is an optional lock or
+        semaphore that is held only while minimap2 is running, the EmuScheduler uses it to limit the number of
+        concurrent alignments while other samples are in the EM stage. The chunk files are passed to minimap2
+        according to self.input_mode, a concatenated file is only written in concat mode.
+        Alignments (sam path) and abundances are cached in self.stage_cache, keyed by the reads, the database and
+        the parameters that change the results.
+        eq_class_tolerance collapses reads into equivalence classes before the EM (see emu.compress_read_classes),
+        reads whose log-likelihoods differ by less than the tolerance share a class and the abundances become
+        approximate. The default None runs the EM over all reads. em_scheme selects SQUAREM accelerated or plain
+        EM iterations (see emu.EM_SCHEMES). With prune_margin, candidates more than this below the best
+        log-likelihood of their read are dropped before the EM (e.g. 4.6 for a 100-fold lower likelihood), the EM
+        prints the number of pruned candidates. prune_report additionally runs the EM without pruning and prints
+        the abundance delta between both estimates. em_shards > 1 splits the EM iterations by read across that
+        many processes (see emu.sharded_em_pool), the abundances do not depend on it.
+        """
         print(f"Running emu with min abundance of {min_abundance}")
+        threads = threads or multiprocessing.cpu_count()
         self.emu_out = f"{ROOT}/src/resources/pipeline_out/{sample_name}/"
 
-        #remove concatenated files from sequence list to avoid concatenating twice
-        sequence_list = [s for s in sequence_list if "concatenated" not in s]
-        # print(sequence_list)
-        concat_file_name = f"{os.path.dirname(sequence_list[0])}/{sample_name}_concatenated.fastq.gz"
-        self.concat_file_name = concat_file_name
-        # print(f"concat_file_name: {concat_file_name}")
-        if not os.path.exists(concat_file_name):
-            self.concatenate_fastq_files(sequence_list, concat_file_name)
-
+        reads = SequenceInput(sequence_list, sample_name, self.input_mode, collect_qc=self.collect_qc)
+        sequence_list = reads.files
+        # QC statistics are calculated from the chunk files directly, unless they are collected during alignment
+        self.concat_file_name = sequence_list
+        self.qc_statistics = None
 
         if ".fasta" in sequence_list[0] or ".fa" in sequence_list[0] or ".fastq" in sequence_list[0]\
                 or ".fq" in sequence_list[0]:
@@ -57,46 +80,146 @@ class EmuRunner:
             #       f" --output-dir {self.emu_out} --threads {multiprocessing.cpu_count()} --type map-ont --output-basename {sample_name}"
             # print(cmd)
             # os.system(cmd)
-            emu_db = f"/home/minion-computer/emu_db/latest/silva"
+            emu_db = self.emu_db
 
-            df_taxonomy = pd.read_csv(os.path.join(emu_db, "taxonomy.tsv"), sep='\t',
-                                      index_col='tax_id', dtype=str)
-            db_species_tids = df_taxonomy.index
+            # compiled once per database and memory-mapped, shared by all samples and worker processes
+            taxonomy = emu.load_taxonomy(emu_db)
+            db_species_tids = taxonomy.tax_ids.tolist()
             print(f"Emu out: {self.emu_out}")
             if not os.path.exists(self.emu_out):
                 os.makedirs(self.emu_out)
 
             out_file_base = self.emu_out
             sam_out = f"{out_file_base}/emu_alignments.sam"
-            tsv_out = f"{out_file_base}/{sample_name}_rel-abundance"
             # print(f"Out file: {out_file_base}")
             print(f"min abundance: {min_abundance}")
-            SAM_FILE = emu.generate_alignments(concat_file_name, sam_out, emu_db, "map-ont",
-                                               f"{multiprocessing.cpu_count()}", 50, 500000000)
-            log_prob_cigar_op, locs_p_cigar_zero, longest_align_dict = \
-                emu.get_cigar_op_log_probabilities(SAM_FILE)
-            log_prob_rgs, counts_unassigned, counts_assigned = emu.log_prob_rgs_dict(
-                SAM_FILE, log_prob_cigar_op, longest_align_dict, locs_p_cigar_zero)
+            align_params = {"minimap_type": "map-ont", "N": 50}
+            em_params = dict(align_params, min_abundance=min_abundance, lli_threshold=.01,
+                             eq_class_tolerance=eq_class_tolerance, em_scheme=em_scheme, prune_margin=prune_margin)
+            em_key = self.stage_cache.key("emu_em", sequence_list, [emu_db], em_params)
+            em_outputs = self.abundance_outputs(sample_name)
+            if self.stage_cache.restore("emu_em", em_key, em_outputs, f"{sample_name} "):
+                return
+            with align_slot or nullcontext(), reads:
+                if stream_alignments:
+                    # minimap2 output is piped straight into scoring, CIGAR summaries are spilled to disk
+                    spill_file = f"{out_file_base}/emu_alignment_stats.bin"
+                    with reads.as_files() as read_files:
+                        align_stats = emu.stream_alignments(read_files, emu_db, "map-ont", f"{threads}",
+                                                            50, 500000000, spill_path=spill_file)
+                else:
+                    sam_key = self.stage_cache.key("emu_alignments", sequence_list, [emu_db], align_params)
+                    sam_outputs = {"emu_alignments.sam": sam_out}
+                    if not self.stage_cache.restore("emu_alignments", sam_key, sam_outputs, f"{sample_name} "):
+                        with reads.as_single_file() as read_file:
+                            emu.generate_alignments(read_file, sam_out, emu_db, "map-ont", f"{threads}", 50,
+                                                    500000000)
+                        self.stage_cache.store("emu_alignments", sam_key, sam_outputs)
+                    align_stats = emu.collect_alignment_stats(sam_out)
+            self.qc_statistics = reads.qc_statistics
+            log_prob_rgs, counts_unassigned, counts_assigned = emu.log_prob_rgs_matrix(align_stats)
+            del align_stats
+            if stream_alignments and os.path.exists(spill_file):
+                os.remove(spill_file)
             f_full, f_set_thresh, read_dist = emu.expectation_maximization_iterations(log_prob_rgs,
                                                                                       db_species_tids,
                                                                                       .01,
-                                                                                      input_threshold=min_abundance)
+                                                                                      input_threshold=min_abundance,
+                                                                                      scheme=em_scheme,
+                                                                                      eq_class_tolerance=eq_class_tolerance,
+                                                                                      read_assignments=False,
+                                                                                      em_workers=em_shards,
+                                                                                      prune_margin=prune_margin)
+            if prune_margin is not None and prune_report:
+                f_unpruned, _, _ = emu.expectation_maximization_iterations(log_prob_rgs, db_species_tids, .01,
+                                                                           input_threshold=min_abundance,
+                                                                           scheme=em_scheme,
+                                                                           eq_class_tolerance=eq_class_tolerance,
+                                                                           read_assignments=False,
+                                                                           em_workers=em_shards)
+                total_variation, max_difference, n_differing = emu.abundance_delta(f_full, f_unpruned)
+                print(f"Pruning abundance delta for sample {sample_name} (margin {prune_margin}): total variation "
+                      f"{total_variation:.6f}, max species difference {max_difference:.6f}, {n_differing} species "
+                      f"only reported with or without pruning")
             # print(f_full)
             # print(f_set_thresh)
 
-            emu.freq_to_lineage_df(f_full, tsv_out, df_taxonomy,
-                                   counts_assigned, counts_unassigned, True)
+            self.write_abundances(f_full, f_set_thresh, taxonomy, counts_assigned, counts_unassigned,
+                                  sample_name)
+            self.stage_cache.store("emu_em", em_key, em_outputs, optional=["rel-abundance-threshold.tsv"])
+
+    def run_emu_incremental(self, sequence_list, sample_name, min_abundance, threads=None, align_slot=None,
+                            eq_class_tolerance=None, em_scheme="squarem", prune_margin=None, em_shards=1):
+        """
+        Incremental version of run_emu for monitoring a running flow cell. The alignments of the reads so far
+        (as weighted rows of identical reads with running cigar op totals, see emu.update_incremental_scores), the
+        list of processed files and the last abundance estimate are stored per sample in
+        emu_incremental_state.npz. On each call only files that were not processed before are aligned, the stored
+        alignments are re-scored and the EM is warm-started from the previous abundances, so no file is aligned
+        twice. The scores are those of run_emu over all files, the estimate only differs within the EM
+        convergence threshold. threads, align_slot, eq_class_tolerance, em_scheme, prune_margin and em_shards
+        behave as in run_emu and are applied to the re-scored reads, the stored state is always exact.
+        """
+        print(f"Running incremental emu with min abundance of {min_abundance}")
+        self.emu_out = f"{ROOT}/src/resources/pipeline_out/{sample_name}/"
+        if not os.path.exists(self.emu_out):
+            os.makedirs(self.emu_out)
+        state_file = os.path.join(self.emu_out, "emu_incremental_state.npz")
+
+        sequence_list = [s for s in sequence_list if "concatenated" not in s]
+        # no concatenated file in incremental mode, QC runs on the chunk files directly
+        self.concat_file_name = sequence_list
+        scores, processed_files, init_freq = None, [], None
+        if os.path.exists(state_file):
+            try:
+                scores, state = emu.load_incremental_scores(state_file)
+                processed_files = state["processed_files"].tolist()
+                init_freq = dict(zip(state["freq_tax_ids"].tolist(), state["freq"].tolist()))
+            except KeyError:
+                # state of an earlier version, start over
+                print(f"Ignoring outdated incremental state {state_file}, all files are aligned again")
+        new_files = sorted(set(sequence_list) - set(processed_files))
+        if not new_files:
+            print(f"No new files for sample {sample_name}, abundances are up to date.")
+            return
+        print(f"Aligning {len(new_files)} new files ({len(processed_files)} already processed)")
+
+        taxonomy = emu.load_taxonomy(self.emu_db)
+        threads = threads or multiprocessing.cpu_count()
+        with align_slot or nullcontext():
+            new_stats = emu.stream_alignments(new_files, self.emu_db, "map-ont", f"{threads}", 50, 500000000)
+        scores = emu.update_incremental_scores(scores, new_stats)
+        del new_stats
+        log_prob_rgs, counts_unassigned, counts_assigned = emu.incremental_read_matrix(scores)
+        f_full, f_set_thresh, _ = emu.expectation_maximization_iterations(log_prob_rgs, taxonomy.tax_ids.tolist(), .01,
+                                                                          input_threshold=min_abundance,
+                                                                          init_freq=init_freq, scheme=em_scheme,
+                                                                          eq_class_tolerance=eq_class_tolerance,
+                                                                          read_assignments=False,
+                                                                          em_workers=em_shards,
+                                                                          prune_margin=prune_margin)
+        self.write_abundances(f_full, f_set_thresh, taxonomy, counts_assigned, counts_unassigned, sample_name)
+        emu.save_incremental_scores(state_file, scores,
+                                    processed_files=processed_files + new_files,
+                                    freq_tax_ids=list(f_full.keys()), freq=list(f_full.values()))
+
+    def abundance_outputs(self, sample_name):
+        """
+        Files written by write_abundances, the threshold file only exists if any taxon passed the threshold.
+        """
+        return {"rel-abundance.tsv": os.path.join(self.emu_out, f"{sample_name}_rel-abundance.tsv"),
+                "rel-abundance-threshold.tsv": os.path.join(self.emu_out, f"{sample_name}_rel-abundance-threshold.tsv")}
 
-            # convert and save frequency to a tsv
-            if f_set_thresh:
-                emu.freq_to_lineage_df(
-                    f_set_thresh,
-                    os.path.join(out_file_base, f"{sample_name}_rel-abundance-threshold"),
+    def write_abundances(self, f_full, f_set_thresh, taxonomy, counts_assigned, counts_unassigned, sample_name):
+        emu.freq_to_lineage_df(f_full, os.path.join(self.emu_out, f"{sample_name}_rel-abundance"), taxonomy,
+                               counts_assigned, counts_unassigned, True)
 
-                    df_taxonomy, counts_assigned, counts_unassigned, True)
-        # remove concatenated file after processing
-        # TODO: calculate statistics and then remove, for now don't remove
-        # os.remove(concat_file_name)
+        # convert and save frequency to a tsv
+        if f_set_thresh:
+            emu.freq_to_lineage_df(
+                f_set_thresh,
+                os.path.join(self.emu_out, f"{sample_name}_rel-abundance-threshold"),
+                taxonomy, counts_assigned, counts_unassigned, True)
 
     def get_files_from_folder(self, folder_path):
         """
@@ -119,12 +242,4 @@ class EmuRunner:
             self.logger.error(f"Invalid folder path")
 
     def concatenate_fastq_files(self, input_files, output_file):
-        with gzip.open(output_file, 'wt') as output:
-            for input_file in input_files:
-                is_gzipped = input_file.endswith(".gz")
-                open_func = gzip.open if is_gzipped else open
-                mode = 'rt' if is_gzipped else 'r'
-
-                with open_func(input_file, mode) as input2:
-                    for line in input2:
-                        output.write(line)
+        FastqConcatenator().concatenate(input_files, output_file)
@@ -0,0 +1,78 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.mmonitor.userside.EmuRunner import EmuRunner
+
+
+def run_emu_sample(emu_runner, files, sample_name, min_abundance, incremental, threads, align_slot, em_options):
+    """
+    Runs emu for one sample inside a worker process of the EmuScheduler and returns the input used for QC: the
+    QCAccumulator collected while the reads were aligned or the list of chunk files. em_options are passed on to
+    run_emu/run_emu_incremental as keyword arguments.
+    """
+    if isinstance(files, str) and os.path.isdir(files):
+        files = emu_runner.get_files_from_folder(files)
+    if incremental:
+        emu_runner.run_emu_incremental(files, sample_name, min_abundance, threads=threads, align_slot=align_slot,
+                                       **em_options)
+    else:
+        emu_runner.run_emu(files, sample_name, min_abundance, threads=threads, align_slot=align_slot,
+                           **em_options)
+    return emu_runner.qc_statistics or emu_runner.concat_file_name
+
+
+class EmuScheduler:
+    """
+    Pipelines emu over multiple samples. Every sample runs in a worker process of a process pool (concatenation,
+    scoring and EM are pure Python/numpy and would serialize on the GIL in threads). minimap2 only runs while a
+    worker holds one of align_jobs alignment slots, so while sample N is in the EM stage the next sample is
+    already aligning. Finished samples are handed back to the calling process in completion order, where the
+    upload to the MMonitor DB and QC run while the pool keeps working on the remaining samples.
+
+    Thread budgets:
+        align_jobs: number of concurrent minimap2 processes
+        align_threads: minimap2 threads per alignment (default: all cores divided by align_jobs)
+        python_workers: number of worker processes for the Python stages on top of the aligning ones, the EM of a
+                        single sample can additionally be sharded with the em_shards option of EmuRunner.run_emu
+    """
+
+    def __init__(self, emu_runner=None, align_jobs=1, align_threads=None, python_workers=1):
+        self.emu_runner = emu_runner or EmuRunner()
+        self.align_jobs = max(1, align_jobs)
+        self.align_threads = align_threads or max(1, multiprocessing.cpu_count() // self.align_jobs)
+        self.python_workers = max(0, python_workers)
+
+    def run(self, samples, min_abundance, incremental=False, on_sample_done=None, em_options=None):
+        """
+        param(list): samples as (sample_name, files) tuples, files is a folder or a list of sequencing files
+        param(float): min_abundance passed on to emu
+        param(bool): incremental use EmuRunner.run_emu_incremental instead of run_emu
+        param(function): on_sample_done callback(sample_name, qc_input) called in this process for every finished
+                         sample
+        param(dict): em_options keyword arguments for run_emu/run_emu_incremental, e.g. eq_class_tolerance
+        return: list of sample names that failed
+        """
+        failed = []
+        if not samples:
+            return failed
+        max_workers = min(len(samples), self.align_jobs + self.python_workers)
+        print(f"Scheduling {len(samples)} samples on {max_workers} workers ({self.align_jobs} concurrent "
+              f"alignments with {self.align_threads} threads each)")
+        with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=max_workers) as pool:
+            align_slot = manager.BoundedSemaphore(self.align_jobs)
+            futures = {pool.submit(run_emu_sample, self.emu_runner, files, sample_name, min_abundance, incremental,
+                                   self.align_threads, align_slot, em_options or {}): sample_name
+                       for sample_name, files in samples}
+            for done, future in enumerate(as_completed(futures), 1):
+                sample_name = futures[future]
+                try:
+                    qc_input = future.result()
+                except Exception as e:
+                    print(f"emu failed for sample {sample_name}: {e}")
+                    failed.append(sample_name)
+                    continue
+                print(f"Finished emu for sample {sample_name} ({done} of {len(samples)})")
+                if on_sample_done is not None:
+                    on_sample_done(sample_name, qc_input)
+        return failed
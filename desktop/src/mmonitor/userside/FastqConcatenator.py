@@ -0,0 +1,111 @@
+import gzip
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class FastqConcatenator:
+    """
+    Concatenates sequencing chunk files (e.g. the 4000 read fastq(.gz) files MinKNOW writes) into one file while
+    touching the data as little as possible:
+        - gzip input to gzip output: the gzip members are copied byte by byte, a concatenation of gzip members
+          is a valid gzip file, so nothing is decompressed or recompressed
+        - plain input to plain output: copied in the kernel with copy_file_range or sendfile
+        - plain input to gzip output: compressed in blocks on threads, every block becomes its own gzip member
+        - gzip input to plain output: decompressed, this is the only case that can't be avoided
+    Whether the output is compressed is decided by its file ending (.gz), whether an input is compressed by its
+    first bytes.
+    """
+
+    def __init__(self, threads=None, compresslevel=6, block_size=4 * 1024 * 1024):
+        self.threads = threads or multiprocessing.cpu_count()
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+
+    @staticmethod
+    def is_gzipped(file_path):
+        with open(file_path, 'rb') as infile:
+            return infile.read(2) == GZIP_MAGIC
+
+    def concatenate(self, input_files, output_file):
+        """
+        Concatenates input_files in the given order into output_file. Files listed twice are only added once.
+        """
+        input_files = list(dict.fromkeys(input_files))
+        compress_output = output_file.endswith(".gz")
+        # unbuffered, so that python writes and kernel copies go to the same file offset
+        with open(output_file, 'wb', buffering=0) as outfile:
+            for input_file in input_files:
+                gzipped = self.is_gzipped(input_file)
+                if gzipped == compress_output:
+                    self.copy_file(input_file, outfile)
+                elif compress_output:
+                    self.compress_file(input_file, outfile)
+                else:
+                    with gzip.open(input_file, 'rb') as infile:
+                        self.write_all(outfile, infile)
+        print(f"Concatenated {len(input_files)} files into {output_file}")
+        return output_file
+
+    @staticmethod
+    def write_bytes(outfile, data):
+        view = memoryview(data)
+        while view:
+            view = view[outfile.write(view):]
+
+    @staticmethod
+    def write_all(outfile, infile):
+        for chunk in iter(partial(infile.read, 1024 * 1024), b''):
+            FastqConcatenator.write_bytes(outfile, chunk)
+
+    @staticmethod
+    def copy_file(input_file, outfile):
+        """
+        Appends input_file to the open outfile without copying the data through python if the kernel supports it.
+        """
+        with open(input_file, 'rb', buffering=0) as infile:
+            remaining = os.fstat(infile.fileno()).st_size
+            for copy in (FastqConcatenator._copy_file_range, FastqConcatenator._sendfile):
+                try:
+                    remaining = copy(infile, outfile, remaining)
+                except (AttributeError, OSError):
+                    continue
+                if remaining == 0:
+                    return
+            FastqConcatenator.write_all(outfile, infile)
+
+    @staticmethod
+    def _copy_file_range(infile, outfile, remaining):
+        while remaining > 0:
+            copied = os.copy_file_range(infile.fileno(), outfile.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+        return remaining
+
+    @staticmethod
+    def _sendfile(infile, outfile, remaining):
+        while remaining > 0:
+            copied = os.sendfile(outfile.fileno(), infile.fileno(), None, remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+        return remaining
+
+    def compress_file(self, input_file, outfile):
+        """
+        Appends input_file gzip compressed to outfile. The file is compressed in blocks of block_size on
+        self.threads threads (zlib releases the GIL), each block is written as a separate gzip member in order.
+        """
+        with open(input_file, 'rb') as infile, ThreadPoolExecutor(max_workers=self.threads) as executor:
+            pending = deque()
+            for block in iter(partial(infile.read, self.block_size), b''):
+                pending.append(executor.submit(gzip.compress, block, self.compresslevel, mtime=0))
+                if len(pending) > 2 * self.threads:
+                    self.write_bytes(outfile, pending.popleft().result())
+            while pending:
+                self.write_bytes(outfile, pending.popleft().result())
@@ -1,127 +1,570 @@
+import bisect
 import gzip
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
 from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
 import numpy as np
-from Bio import SeqIO
-import time
-import json
 
-def process_fastq_file(file_path):
-    sequences_temp = []
-    qualities_temp = []
-    local_gc_counts = []
-    local_lengths = []
-    local_q20_counts = []
-    local_q30_counts = []
-
-    is_gzipped = file_path.endswith(".gz")
-    with (gzip.open(file_path, 'rt') if is_gzipped else open(file_path, 'r')) as f:
-        read_count = 0  # Initialize read count
-        for record in SeqIO.parse(f, "fastq"):
-            if read_count >= 20:  # Adjust the threshold as needed
-                break  # Stop reading if the threshold is exceeded
-            seq = str(record.seq)
-            sequences_temp.append(seq)  # Optional
-            quality_scores = np.array(record.letter_annotations["phred_quality"], dtype=int)
-            qualities_temp.append(quality_scores)
-            local_gc_counts.append(seq.count('G') + seq.count('C'))
-            local_lengths.append(len(seq))
-            read_count += 1  # Increment read count
+# files are read in blocks of this size, memory use doesn't depend on the file size
+CHUNK_SIZE = 4 * 1024 * 1024
+# read lengths are counted exactly up to this length, longer reads share the last bin. Qualities per position are
+# summed for the first LENGTH_HISTOGRAM_SIZE - 1 positions
+LENGTH_HISTOGRAM_SIZE = 100_000
+# phred scores are offset by 33 in fastq, printable characters allow scores from 0 to 93
+MAX_QUALITY = 93
+# number of reads kept for the per-read plots (quality vs. length, gc content per read)
+RESERVOIR_SIZE = 10_000
+# translation table mapping the bases counted as gc to 1 and all other bytes to 0
+GC_TABLE = bytes(1 if byte in b"GCgc" else 0 for byte in range(256))
+# reads longer than this on average add their qualities per position with one slice addition per read, shorter
+# reads with a single bincount over all bases of the block
+MIN_MEAN_LENGTH_PER_READ_ADDITION = 64
+# large files are split into ranges of at least this many (uncompressed) bytes that are processed in parallel
+MIN_RANGE_SIZE = 64 * 1024 * 1024
+# fixed part of a bgzf block header, including the BC extra subfield holding the block size
+BGZF_HEADER_SIZE = 18
 
-    return {
-        'sequences': sequences_temp,
-        'qualities': qualities_temp,
-        'gc_counts': local_gc_counts,
-        'lengths': local_lengths,
-        'q20_counts': local_q20_counts,
-        'q30_counts': local_q30_counts
-    }
 
+# a byte range of a fastq file, records whose header starts in (start, end] belong to the range (the first range of
+# a file also gets the record at 0). Positions are offsets in the uncompressed data, seek_offset is the offset in the
+# file where reading starts: start for plain files, the compressed offset of the block holding start for bgzf files
+FastqRange = namedtuple("FastqRange", ["file_path", "start", "end", "seek_offset"])
 
-class FastqStatistics:
 
-    def __init__(self, file_paths, multi=True, num_threads=64):
-        self.file_paths = file_paths if isinstance(file_paths, list) else [file_paths]
-        # Initialize lists and numpy arrays for aggregated data
-        self.sequences = []
-        self.qualities = []
-        self.lengths = np.array([], dtype=int)
-        self.gc_counts = np.array([], dtype=int)
-        self.q20_counts = np.array([], dtype=int)
-        self.q30_counts = np.array([], dtype=int)
+def open_fastq(file_path):
+    return gzip.open(file_path, 'rb') if file_path.endswith(".gz") else open(file_path, 'rb')
+
+
+@contextmanager
+def open_fastq_range(fastq_range):
+    """
+    Opens the file of fastq_range positioned at fastq_range.start.
+    """
+    if fastq_range.start == 0 and fastq_range.seek_offset == 0:
+        with open_fastq(fastq_range.file_path) as f:
+            yield f
+        return
+    with open(fastq_range.file_path, 'rb') as f:
+        f.seek(fastq_range.seek_offset)
+        if is_bgzf(fastq_range.file_path):
+            # the range starts at a bgzf block, i.e. at a gzip member, decompression can start there
+            with gzip.GzipFile(fileobj=f, mode='rb') as gz:
+                yield gz
+        else:
+            yield f
+
+
+def is_bgzf(file_path):
+    """
+    True if the file is gzip with the BC extra field of bgzf (bgzip, samtools), its blocks can be decompressed
+    independently.
+    """
+    with open(file_path, 'rb') as f:
+        header = f.read(BGZF_HEADER_SIZE)
+    return (len(header) == BGZF_HEADER_SIZE and header[:4] == b"\x1f\x8b\x08\x04"
+            and header[10:12] == b"\x06\x00" and header[12:14] == b"BC")
+
+
+def bgzf_blocks(file_path):
+    """
+    Reads only the headers and the uncompressed sizes (last 4 bytes) of the blocks of a bgzf file.
+    return: list of (compressed offset, uncompressed offset) of every block
+    """
+    blocks = []
+    compressed_offset, uncompressed_offset = 0, 0
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        while compressed_offset < file_size:
+            f.seek(compressed_offset)
+            header = f.read(BGZF_HEADER_SIZE)
+            if len(header) < BGZF_HEADER_SIZE or header[12:14] != b"BC":
+                raise ValueError(f"{file_path} has an invalid bgzf block at offset {compressed_offset}")
+            block_size = struct.unpack("<H", header[16:18])[0] + 1
+            f.seek(compressed_offset + block_size - 4)
+            blocks.append((compressed_offset, uncompressed_offset))
+            uncompressed_offset += struct.unpack("<I", f.read(4))[0]
+            compressed_offset += block_size
+    return blocks
+
+
+def fastq_ranges(file_path, parts):
+    """
+    Splits a fastq file into at most parts ranges of at least MIN_RANGE_SIZE bytes that can be processed
+    independently. Plain files are split at arbitrary byte offsets, bgzf files at block boundaries. Other gzip
+    files can't be entered in the middle and are a single range.
+    """
+    whole_file = [FastqRange(file_path, 0, None, 0)]
+    if file_path.endswith(".gz"):
+        if not is_bgzf(file_path):
+            return whole_file
+        blocks = bgzf_blocks(file_path)
+        size = blocks[-1][1] if blocks else 0
+    else:
+        blocks = None
+        size = os.path.getsize(file_path)
+    parts = max(1, min(parts, size // MIN_RANGE_SIZE))
+    if parts == 1:
+        return whole_file
+    starts = [size * part // parts for part in range(parts)]
+    if blocks is not None:
+        # move every start to the beginning of the block holding it
+        block_starts = [uncompressed for _, uncompressed in blocks]
+        indices = sorted({bisect.bisect_right(block_starts, start) - 1 for start in starts})
+        starts = [block_starts[index] for index in indices]
+        seek_offsets = [blocks[index][0] for index in indices]
+    else:
+        seek_offsets = starts
+    ends = starts[1:] + [None]
+    return [FastqRange(file_path, start, end, seek_offset)
+            for start, end, seek_offset in zip(starts, ends, seek_offsets)]
+
+
+def parse_fastq_lines(lines, file_path):
+    """
+    param(list): lines of complete fastq records (4 lines per record)
+    return: (sequences, quality strings, read lengths), sequences and quality strings of all reads concatenated
+    """
+    if not all(header.startswith(b"@") for header in lines[0::4]):
+        header = next(header for header in lines[0::4] if not header.startswith(b"@"))
+        raise ValueError(f"{file_path} is not a fastq file, expected a record header but got {header[:50]}")
+    sequences, qualities = lines[1::4], lines[3::4]
+    if any(line.endswith(b"\r") for line in sequences[:1]):
+        sequences = [line.rstrip(b"\r") for line in sequences]
+        qualities = [line.rstrip(b"\r") for line in qualities]
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    quality_lengths = np.fromiter(map(len, qualities), dtype=np.int64, count=len(qualities))
+    if not np.array_equal(lengths, quality_lengths):
+        raise ValueError(f"Sequence and quality of a read in {file_path} differ in length")
+    return b"".join(sequences), b"".join(qualities), lengths
+
+
+def skip_to_record(f, chunk_size, position):
+    """
+    Reads from the middle of a fastq file up to the first record header after position. A line starting with @ can
+    be a header or a quality line, it is a header if the line after the next starts with + (a sequence line never
+    does).
+    return: (data read from the header on, position of the header)
+    """
+    data = b""
+    while True:
+        chunk = f.read(chunk_size)
+        data += chunk
+        # the line at position belongs to the previous range, even if it is complete
+        offset = data.find(b"\n") + 1
+        if offset > 0:
+            lines = data[offset:].split(b"\n")
+            # without further data only lines followed by a complete third line can be checked
+            checked = len(lines) - 2 if chunk else len(lines)
+            for i in range(max(0, checked - 2)):
+                if lines[i].startswith(b"@") and lines[i + 2].startswith(b"+"):
+                    return data[offset:], position + offset
+                offset += len(lines[i]) + 1
+        if not chunk:
+            return b"", position + len(data)
+
+
+def complete_lines(lines, file_path, end_of_file=False):
+    """
+    Number of lines that form complete records. Before the end of the file the last line may be incomplete and the
+    lines of an incomplete record are left for the next block. At the end of the file trailing blank lines are
+    removed from lines.
+    """
+    if not end_of_file:
+        return (len(lines) - 1) // 4 * 4
+    if lines and lines[-1] == b"":
+        # the line break at the end of the file
+        lines.pop()
+    while len(lines) % 4 and not lines[-1].strip():
+        # blank lines after the last record, the lines of empty reads are kept
+        lines.pop()
+    if len(lines) % 4:
+        raise ValueError(f"{file_path} ends with an incomplete fastq record")
+    return len(lines)
+
+
+def iter_fastq_blocks(file_path, chunk_size=CHUNK_SIZE, fastq_range=None):
+    """
+    Reads a fastq file (4 lines per record) in blocks of chunk_size bytes, the records of a block are processed
+    together. With fastq_range only the records of the range are read.
+    return: generator of (sequences, quality strings, read lengths) of the complete records of every block
+    """
+    fastq_range = fastq_range or FastqRange(file_path, 0, None, 0)
+    with open_fastq_range(fastq_range) as f:
+        remainder, position = b"", fastq_range.start
+        if fastq_range.start > 0:
+            remainder, position = skip_to_record(f, chunk_size, position)
+        while True:
+            chunk = f.read(chunk_size)
+            data = remainder + chunk
+            lines = data.split(b"\n")
+            complete = complete_lines(lines, file_path, end_of_file=not chunk)
+            if fastq_range.end is not None and position + len(data) > fastq_range.end:
+                # stop after the last record whose header is at or before the end of the range
+                line_ends = position + np.cumsum(np.fromiter(map(len, lines[:complete]), dtype=np.int64,
+                                                             count=complete) + 1)
+                header_positions = np.concatenate(([position], line_ends[3:complete - 1:4]))
+                records = int(np.searchsorted(header_positions, fastq_range.end, side='right'))
+                if records < complete // 4:
+                    if records:
+                        yield parse_fastq_lines(lines[:records * 4], file_path)
+                    return
+            if complete:
+                yield parse_fastq_lines(lines[:complete], file_path)
+            if not chunk:
+                return
+            remainder = b"\n".join(lines[complete:])
+            position += len(data) - len(remainder)
+
+
+class QCStream:
+    """
+    File-like sink that computes QC statistics of fastq data written to it in pieces of any size, e.g. by a pass
+    that streams the reads to a classifier anyway (see SequenceInput.ingest). close() returns the QCAccumulator.
+    """
+
+    def __init__(self, name="stream"):
+        self.name = name
+        self.accumulator = QCAccumulator()
+        self.remainder = b""
+
+    def write(self, data):
+        lines = (self.remainder + data).split(b"\n")
+        complete = complete_lines(lines, self.name)
+        if complete:
+            self.accumulator.add_reads(*parse_fastq_lines(lines[:complete], self.name))
+        self.remainder = b"\n".join(lines[complete:])
+        return len(data)
+
+    def close(self):
+        lines = self.remainder.split(b"\n")
+        complete = complete_lines(lines, self.name, end_of_file=True)
+        if complete:
+            self.accumulator.add_reads(*parse_fastq_lines(lines, self.name))
+        self.remainder = b""
+        return self.accumulator
+
+
+def process_fastq_range(fastq_range):
+    accumulator = QCAccumulator()
+    for sequences, qualities, lengths in iter_fastq_blocks(fastq_range.file_path, fastq_range=fastq_range):
+        accumulator.add_reads(sequences, qualities, lengths)
+    return accumulator
+
+
+class QCAccumulator:
+    """
+    Running QC statistics of a stream of reads with memory independent of the number of reads:
+        - read length histogram (exact up to LENGTH_HISTOGRAM_SIZE) and the exact min/max/total length
+        - sum of the qualities at every read position
+        - histogram of the phred scores of all bases, Q20/Q30 counts follow from it
+        - histogram of the gc content of the reads in percent
+        - reservoir sample of RESERVOIR_SIZE reads (length, mean quality, gc content) for the per-read plots
+    Reads are added in blocks and all statistics of a block are computed with numpy on the concatenated sequences
+    and quality strings. Accumulators of different files can be merged.
+    """
+
+    def __init__(self, reservoir_size=RESERVOIR_SIZE, seed=None):
+        self.number_of_reads = 0
         self.total_bases = 0
-        self.load_files(multi, num_threads)
+        self.min_length = None
+        self.max_length = 0
+        self.gc_bases = 0
+        self.read_quality_sum = 0.0
+        self.length_histogram = np.zeros(LENGTH_HISTOGRAM_SIZE, dtype=np.int64)
+        self.position_quality_sums = np.zeros(LENGTH_HISTOGRAM_SIZE - 1, dtype=np.int64)
+        self.quality_histogram = np.zeros(MAX_QUALITY + 1, dtype=np.int64)
+        self.gc_histogram = np.zeros(101, dtype=np.int64)
+        self.reservoir_size = reservoir_size
+        # columns: read length, mean quality, gc content in percent, the first reservoir_count rows are filled
+        self.reservoir = np.zeros((reservoir_size, 3), dtype=np.float64)
+        self.reservoir_count = 0
+        self.rng = np.random.default_rng(seed)
 
-    def load_files(self, multi, num_threads):
-        if multi:
-            self.load_files_parallel(num_threads)
+    def add_reads(self, sequences, qualities, lengths):
+        """
+        param(bytes): sequences of the reads concatenated
+        param(bytes): quality strings (phred + 33) of the reads concatenated
+        param(np.ndarray): length of every read
+        """
+        if len(lengths) == 0:
+            return
+        quality_bytes = np.frombuffer(qualities, dtype=np.uint8)
+        if len(quality_bytes) and (quality_bytes.min() < 33 or quality_bytes.max() > 33 + MAX_QUALITY):
+            raise ValueError("Quality string contains characters outside of the phred+33 range")
+        phred = quality_bytes - 33
+        gc_flags = np.frombuffer(sequences.translate(GC_TABLE), dtype=np.uint8)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        nonempty = lengths > 0
+        read_quality_sums = np.zeros(len(lengths), dtype=np.int64)
+        read_gc = np.zeros(len(lengths), dtype=np.int64)
+        if len(phred):
+            # reduceat sums from one read start to the next, empty reads are left out so they don't split a read
+            read_quality_sums[nonempty] = np.add.reduceat(phred, starts[nonempty], dtype=np.int64)
+            read_gc[nonempty] = np.add.reduceat(gc_flags, starts[nonempty], dtype=np.int64)
+        mean_qualities = np.divide(read_quality_sums, lengths, out=np.zeros(len(lengths)), where=nonempty)
+        gc_contents = np.divide(100 * read_gc, lengths, out=np.zeros(len(lengths)), where=nonempty)
+
+        self.number_of_reads += len(lengths)
+        self.total_bases += int(ends[-1])
+        block_min = int(lengths.min())
+        self.min_length = block_min if self.min_length is None else min(self.min_length, block_min)
+        self.max_length = max(self.max_length, int(lengths.max()))
+        self.gc_bases += int(read_gc.sum())
+        self.read_quality_sum += float(mean_qualities.sum())
+        self.length_histogram += np.bincount(np.minimum(lengths, LENGTH_HISTOGRAM_SIZE - 1),
+                                             minlength=LENGTH_HISTOGRAM_SIZE)
+        tracked = len(self.position_quality_sums)
+        if len(phred) >= MIN_MEAN_LENGTH_PER_READ_ADDITION * len(lengths):
+            for start, length in zip(starts.tolist(), np.minimum(lengths, tracked).tolist()):
+                self.position_quality_sums[:length] += phred[start:start + length]
         else:
-            for file_path in self.file_paths:
-                result = process_fastq_file(file_path)
-                self.aggregate_results(result)
+            # position of every base within its read
+            positions = np.arange(len(phred)) - np.repeat(starts, lengths)
+            in_range = positions < tracked
+            self.position_quality_sums += np.bincount(positions[in_range], weights=phred[in_range],
+                                                      minlength=tracked).astype(np.int64)
+        self.quality_histogram += np.bincount(phred, minlength=MAX_QUALITY + 1)
+        self.gc_histogram += np.bincount(np.rint(gc_contents).astype(np.int64), minlength=101)
+        self.add_to_reservoir(np.column_stack([lengths, mean_qualities, gc_contents]))
 
-    def load_files_parallel(self, num_threads):
-        start_time = time.time()
-        with ProcessPoolExecutor(max_workers=num_threads) as executor:
-            results = list(executor.map(process_fastq_file, self.file_paths))
-        for result in results:
-            self.aggregate_results(result)
-        end_time = time.time()
-        print(f"Loaded files in {end_time - start_time} seconds")
+    def add_to_reservoir(self, reads):
+        """
+        Reservoir sampling (algorithm R) of a block of reads, every read ends up in the sample with the same
+        probability. number_of_reads must already include the reads of the block.
+        """
+        fill = min(len(reads), self.reservoir_size - self.reservoir_count)
+        self.reservoir[self.reservoir_count:self.reservoir_count + fill] = reads[:fill]
+        self.reservoir_count += fill
+        if fill == len(reads):
+            return
+        # the i-th read of the stream replaces a random slot with probability reservoir_size / i
+        read_numbers = np.arange(self.number_of_reads - len(reads) + fill, self.number_of_reads) + 1
+        slots = (self.rng.random(len(read_numbers)) * read_numbers).astype(np.int64)
+        accepted = np.nonzero(slots < self.reservoir_size)[0]
+        # a slot hit several times keeps the last read, as if the reads were added one by one
+        last_slots, last_index = np.unique(slots[accepted][::-1], return_index=True)
+        self.reservoir[last_slots] = reads[fill:][accepted[::-1][last_index]]
+
+    def merge(self, other):
+        """
+        Adds the statistics of other, e.g. of another file of the same sample.
+        """
+        if other.number_of_reads == 0:
+            return self
+        seen, other_seen = self.number_of_reads, other.number_of_reads
+        self.number_of_reads += other.number_of_reads
+        self.total_bases += other.total_bases
+        self.min_length = other.min_length if self.min_length is None else min(self.min_length, other.min_length)
+        self.max_length = max(self.max_length, other.max_length)
+        self.gc_bases += other.gc_bases
+        self.read_quality_sum += other.read_quality_sum
+        self.length_histogram += other.length_histogram
+        self.position_quality_sums += other.position_quality_sums
+        self.quality_histogram += other.quality_histogram
+        self.gc_histogram += other.gc_histogram
+
+        sample, other_sample = self.sample(), other.sample()
+        if len(sample) + len(other_sample) <= self.reservoir_size:
+            merged = np.vstack([sample, other_sample])
+        else:
+            # reads of both samples are drawn in proportion to the number of reads they represent
+            from_self = self.rng.hypergeometric(seen, other_seen, self.reservoir_size)
+            from_self = min(max(from_self, self.reservoir_size - len(other_sample)), len(sample))
+            merged = np.vstack([
+                sample[self.rng.choice(len(sample), from_self, replace=False)],
+                other_sample[self.rng.choice(len(other_sample), self.reservoir_size - from_self, replace=False)],
+            ])
+        self.reservoir[:len(merged)] = merged
+        self.reservoir_count = len(merged)
+        return self
+
+    def sample(self):
+        """
+        return: array of the sampled reads with the columns read length, mean quality, gc content
+        """
+        return self.reservoir[:self.reservoir_count]
 
-    def aggregate_results(self, result):
-        # Aggregate results here, similar to the load_file method adjustments
-        self.sequences.extend(result['sequences'])
-        self.qualities.extend(result['qualities'])
-        self.lengths = np.concatenate([self.lengths, np.array(result['lengths'], dtype=int)])
-        self.gc_counts = np.concatenate([self.gc_counts, np.array(result['gc_counts'], dtype=int)])
-        self.q20_counts = np.concatenate([self.q20_counts, np.array(result['q20_counts'], dtype=int)])
-        self.q30_counts = np.concatenate([self.q30_counts, np.array(result['q30_counts'], dtype=int)])
-        self.total_bases += np.sum(result['lengths'])
+    def reads_per_position(self):
+        """
+        Number of reads covering every position of position_quality_sums.
+        """
+        longer_reads = self.number_of_reads - np.cumsum(self.length_histogram)
+        return longer_reads[:len(self.position_quality_sums)]
 
+    def median_length(self):
+        if self.number_of_reads == 0:
+            return 0
+        cumulative = np.cumsum(self.length_histogram)
+        lower = int(np.searchsorted(cumulative, (self.number_of_reads + 1) // 2))
+        upper = int(np.searchsorted(cumulative, self.number_of_reads // 2 + 1))
+        return (lower + upper) / 2
 
 
+def process_fastq_file(file_path):
+    return process_fastq_range(FastqRange(file_path, 0, None, 0))
+
+
+class FastqStatistics:
+    """
+    QC statistics of all reads in the given fastq files. The files are streamed, only the running statistics of a
+    QCAccumulator are kept in memory. Per-read values (qualities_vs_lengths, gc_content_per_sequence) come from a
+    random sample of RESERVOIR_SIZE reads.
+    With multi, the files are split into ranges (see fastq_ranges) that are processed by a pool of processes, so a
+    single large file (plain or bgzf) uses all cores as well. Every given file is read, duplicates only once.
+    """
+
+    def __init__(self, file_paths=None, multi=True, num_threads=None, statistics=None):
+        file_paths = file_paths if isinstance(file_paths, list) else [file_paths] if file_paths else []
+        if statistics is not None:
+            # collected while the reads were streamed to another tool (see QCStream), the files are not read again
+            self.file_paths = file_paths
+            self.statistics = statistics
+            return
+        self.file_paths = list(dict.fromkeys(file_paths))
+        self.statistics = QCAccumulator()
+        self.load_files(multi, num_threads)
+
+    def load_files(self, multi, num_threads=None):
+        start_time = time.time()
+        workers = min(num_threads or multiprocessing.cpu_count(), multiprocessing.cpu_count()) if multi else 1
+        ranges = [fastq_range for file_path in self.file_paths for fastq_range in fastq_ranges(file_path, workers)]
+        if workers > 1 and len(ranges) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+                for result in executor.map(process_fastq_range, ranges):
+                    self.statistics.merge(result)
+        else:
+            for fastq_range in ranges:
+                self.statistics.merge(process_fastq_range(fastq_range))
+        print(f"Loaded {self.number_of_reads()} reads from {len(self.file_paths)} files ({len(ranges)} ranges) in "
+              f"{time.time() - start_time:.1f} seconds")
+
     def number_of_reads(self):
-        return len(self.sequences)
+        return self.statistics.number_of_reads
 
     def total_bases_sequenced(self):
-        return self.total_bases
+        return self.statistics.total_bases
 
     def q20_q30_scores(self):
-        q20_percentage = (self.q20_counts.sum() / self.total_bases) * 100
-        q30_percentage = (self.q30_counts.sum() / self.total_bases) * 100
+        if self.statistics.total_bases == 0:
+            return 0, 0
+        quality_histogram = self.statistics.quality_histogram
+        q20_percentage = (quality_histogram[20:].sum() / self.statistics.total_bases) * 100
+        q30_percentage = (quality_histogram[30:].sum() / self.statistics.total_bases) * 100
         return q20_percentage, q30_percentage
 
     def gc_content(self):
-        if self.total_bases > 0:
-            return (self.gc_counts.sum() / self.total_bases) * 100
+        if self.statistics.total_bases > 0:
+            return (self.statistics.gc_bases / self.statistics.total_bases) * 100
         else:
             return 0  # or some other appropriate value indicating no GC content could be calculated
 
     def read_lengths_statistics(self):
-        if len(self.lengths) == 0:
+        if self.statistics.number_of_reads == 0:
             return {}
         return {
-            'min_length': np.min(self.lengths),
-            'max_length': np.max(self.lengths),
-            'mean_length': np.mean(self.lengths),
-            'median_length': np.median(self.lengths)
+            'min_length': self.statistics.min_length,
+            'max_length': self.statistics.max_length,
+            'mean_length': self.statistics.total_bases / self.statistics.number_of_reads,
+            'median_length': self.statistics.median_length()
         }
 
     def quality_statistics(self):
-        all_quality_scores = np.concatenate(self.qualities)
+        quality_histogram = self.statistics.quality_histogram
+        observed = np.nonzero(quality_histogram)[0]
+        if len(observed) == 0:
+            return {}
         return {
-            'min_quality': np.min(all_quality_scores),
-            'max_quality': np.max(all_quality_scores),
-            'mean_quality': np.mean(all_quality_scores),
+            'min_quality': int(observed[0]),
+            'max_quality': int(observed[-1]),
+            'mean_quality': (quality_histogram * np.arange(len(quality_histogram))).sum() / quality_histogram.sum(),
         }
 
+    def mean_read_quality(self):
+        """
+        Mean of the mean qualities of all reads.
+        """
+        if self.statistics.number_of_reads == 0:
+            return 0
+        return self.statistics.read_quality_sum / self.statistics.number_of_reads
+
+    def quality_per_position(self):
+        """
+        Mean quality at every read position up to the length of the longest read.
+        """
+        reads_per_position = self.statistics.reads_per_position()
+        covered = reads_per_position > 0
+        return (self.statistics.position_quality_sums[covered] / reads_per_position[covered]).tolist()
+
+    def read_length_histogram(self):
+        """
+        Number of reads of every length in bp, reads of LENGTH_HISTOGRAM_SIZE - 1 bp or longer are in the last bin.
+        """
+        return self.statistics.length_histogram[:self.statistics.max_length + 1]
+
+    def gc_content_histogram(self):
+        """
+        Number of reads per gc content, bin i holds the reads with a gc content that rounds to i percent.
+        """
+        return self.statistics.gc_histogram
+
     def qualities_vs_lengths(self):
-        avg_qualities = [np.mean(quals) for quals in self.qualities]
         return {
-            'read_lengths': self.lengths.tolist(),
-            'avg_qualities': avg_qualities
+            'read_lengths': self.statistics.sample()[:, 0].astype(int).tolist(),
+            'avg_qualities': self.statistics.sample()[:, 1].tolist()
         }
 
     def gc_content_per_sequence(self):
-        gc_contents = (self.gc_counts.sum() / self.lengths) * 100
-        return gc_contents.tolist()
+        return self.statistics.sample()[:, 2].tolist()
+
+
+def seqio_statistics(file_path):
+    """
+    Read count, bases, gc bases and Q20/Q30 bases of a file computed per record with Biopython, the way
+    process_fastq_file worked before the block parser. Only used as reference by benchmark.
+    """
+    from Bio import SeqIO
+    reads, bases, gc_bases, q20_bases, q30_bases = 0, 0, 0, 0, 0
+    with gzip.open(file_path, 'rt') if file_path.endswith(".gz") else open(file_path, 'r') as f:
+        for record in SeqIO.parse(f, "fastq"):
+            seq = str(record.seq)
+            quality_scores = np.array(record.letter_annotations["phred_quality"], dtype=int)
+            reads += 1
+            bases += len(seq)
+            gc_bases += seq.count('G') + seq.count('C') + seq.count('g') + seq.count('c')
+            q20_bases += int((quality_scores >= 20).sum())
+            q30_bases += int((quality_scores >= 30).sum())
+    return reads, bases, gc_bases, q20_bases, q30_bases
+
+
+def benchmark(file_path):
+    """
+    Compares the block parser with per-record parsing by Biopython on file_path and checks that both agree.
+    """
+    start_time = time.time()
+    reference = seqio_statistics(file_path)
+    seqio_time = time.time() - start_time
+    start_time = time.time()
+    accumulator = process_fastq_file(file_path)
+    block_time = time.time() - start_time
+    result = (accumulator.number_of_reads, accumulator.total_bases, accumulator.gc_bases,
+              int(accumulator.quality_histogram[20:].sum()), int(accumulator.quality_histogram[30:].sum()))
+    if result != reference:
+        raise ValueError(f"Block parser and Biopython disagree: {result} != {reference}")
+    size_mb = os.path.getsize(file_path) / 1024 ** 2
+    print(f"{file_path}: {accumulator.number_of_reads} reads, {accumulator.total_bases} bases ({size_mb:.0f} MB)")
+    print(f"Biopython SeqIO: {seqio_time:.1f} s ({size_mb / seqio_time:.1f} MB/s)")
+    print(f"Block parser:    {block_time:.1f} s ({size_mb / block_time:.1f} MB/s), "
+          f"{seqio_time / block_time:.1f}x faster")
+
+
+if __name__ == "__main__":
+    # python FastqStatistics.py reads.fastq[.gz] ...
+    for benchmark_file in sys.argv[1:]:
+        benchmark(benchmark_file)
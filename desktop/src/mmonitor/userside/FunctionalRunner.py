@@ -2,7 +2,9 @@ import glob
 import logging
 import multiprocessing
 import os.path
+import re
 import subprocess
+import tempfile
 import zipfile
 from os import path
 
@@ -11,6 +13,9 @@ import requests
 
 from build_mmonitor_pyinstaller import ROOT
 
+# columns of the prokka tsv and the two columns added for keggcharter
+KEGGCHARTER_COLUMNS = ["locus_tag", "ftype", "length_bp", "gene", "EC_number", "COG", "product", "taxonomy", "bin"]
+
 """
 This is a runner for a functional analysis pipeline. As input it takes raw nanopore reads, then assembles them with
 flye then corrects the assembly medaka, bins with metabat2, assigns taxonomy with gtdb-tk, annotatts MAGs with gtdb-tk
@@ -121,8 +126,15 @@ class FunctionalRunner:
                 "Make sure that racon is installed and on the system path. For more info visit https://github.com/bbuchfink/diamond")
 
 
-    def run_flye(self, read_file_path, sample_name, hq, meta):
+    def run_flye(self, read_file_path, sample_name, hq, meta, cpus=None):
+        """
+        read_file_path is a single read file or a list of read files, flye takes multiple inputs so chunk files don't
+        have to be concatenated. flye reads its input multiple times, so don't pass a fifo.
+        cpus defaults to all cores (self.cpus), the PipelineExecutor passes the budget of the step.
+        """
+        cpus = cpus or self.cpus
         print("Running flye for assembly...")
+        read_files = [read_file_path] if isinstance(read_file_path, str) else list(read_file_path)
 
         output_dir = os.path.join(self.resources_path, "pipeline_out")
         print(output_dir)
@@ -138,9 +150,9 @@ class FunctionalRunner:
         # Construct Flye command
         flye_cmd = [
             f"{self.flye_path}",
-            read_type, read_file_path,
+            read_type, *read_files,
             "--out-dir", os.path.join(output_dir, sample_name),
-            "-t", str(self.cpus)
+            "-t", str(cpus)
         ]
 
         # Append --meta if meta is True
@@ -154,76 +166,94 @@ class FunctionalRunner:
             return os.path.join(output_dir, sample_name, "assembly.fasta")
         except subprocess.CalledProcessError as e:
             print("Error executing Flye command:", e.stderr)
-
-
-    def run_metabat2_pipeline(self, contig_file, read_file, dir_path):
+            raise
+
+
+    def align_reads_to_contigs(self, contig_file, read_files, sorted_bam_file, cpus=None):
+        """
+        Aligns reads to the contigs with minimap2 and pipes the SAM stream straight into samtools sort, so the only
+        file written is the sorted BAM (no SAM, no unsorted BAM). minimap2 and samtools sort share the cpus.
+        On failure the partial BAM and the temporary files of samtools sort are removed.
+        return: True if the sorted BAM was written
+        """
+        cpus = cpus or self.cpus
+        sort_threads = max(1, cpus // 4)
+        align_threads = max(1, cpus - sort_threads)
+        tmp_prefix = f"{sorted_bam_file}.sort_tmp"
+        minimap2_cmd = ["minimap2", "-ax", "map-ont", "-t", str(align_threads), contig_file, *read_files]
+        sort_cmd = ["samtools", "sort", "-@", str(sort_threads), "-T", tmp_prefix, "-o", sorted_bam_file, "-"]
+        print(f"minimap2 cmd: {' '.join(minimap2_cmd)} | {' '.join(sort_cmd)}")
+        # stderr goes to temporary files, reading two pipes while waiting for both processes could deadlock
+        with tempfile.TemporaryFile() as minimap2_err, tempfile.TemporaryFile() as sort_err:
+            minimap2 = subprocess.Popen(minimap2_cmd, stdout=subprocess.PIPE, stderr=minimap2_err)
+            sort = subprocess.Popen(sort_cmd, stdin=minimap2.stdout, stderr=sort_err)
+            # only samtools holds the read end now, so minimap2 gets SIGPIPE if samtools exits early
+            minimap2.stdout.close()
+            sort.wait()
+            minimap2.wait()
+            if minimap2.returncode == 0 and sort.returncode == 0:
+                return True
+            for name, process, err in (("minimap2", minimap2, minimap2_err), ("samtools sort", sort, sort_err)):
+                if process.returncode != 0:
+                    err.seek(0)
+                    print(f"Error executing {name} command for {read_files}:", err.read().decode(errors="replace"))
+        for partial_file in [sorted_bam_file] + glob.glob(f"{tmp_prefix}.*"):
+            if os.path.exists(partial_file):
+                os.remove(partial_file)
+        return False
+
+    def run_metabat2_pipeline(self, contig_file, read_file, dir_path, cpus=None):
+        """
+        read_file is a single read file (may be a fifo) or a list of read files, minimap2 aligns them in order.
+        The alignment is streamed into a sorted BAM, indexed, summarized into depth.txt and then binned with
+        metabat2. Files of a failed stage are removed, so depth.txt only exists if it is complete, and the error is
+        raised, so the pipeline step fails.
+        """
+        cpus = cpus or self.cpus
+        read_files = [read_file] if isinstance(read_file, str) else list(read_file)
         output_dir = os.path.join(dir_path, "metabat_bins")
+        os.makedirs(dir_path, exist_ok=True)
 
-        # Create output directory if it doesn't exist
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        sam_files = []
-        bam_files = []
-
-        # Align reads to contigs using minimap2
-        sam_file = os.path.join(dir_path, os.path.basename(read_file)) + ".sam"
-        minimap2_cmd = [
-            "minimap2",
-            "-ax", "map-ont", contig_file,
-            read_file,
-            "-o", sam_file
-        ]
+        # Align reads to contigs using minimap2, sorted on the fly by samtools
+        sorted_bam_file = os.path.join(dir_path, f"{os.path.basename(os.path.normpath(dir_path))}_reads.sorted.bam")
+        if not self.align_reads_to_contigs(contig_file, read_files, sorted_bam_file, cpus):
+            raise RuntimeError(f"Aligning the reads to {contig_file} failed")
         try:
-            print(f"minimap2 cmd: {minimap2_cmd}")
-            result = subprocess.run(minimap2_cmd, check=True, text=True, capture_output=True)
-            print("Aligned reads to assembly", result.stdout)
-            sam_files.append(sam_file)
-            print(sam_files)
+            subprocess.run(["samtools", "index", "-@", str(cpus), sorted_bam_file], check=True, text=True,
+                           capture_output=True)
         except subprocess.CalledProcessError as e:
-            print(f"Error executing minimap2 command for {read_file}:", e.stderr)
-            return
-
-        # convert to bam, sort and index resulting sam file
-        for sam_file in sam_files:
-            bam_file = sam_file.replace(".sam", ".bam")
-            sorted_bam_file = bam_file.replace(".bam", ".sorted.bam")
-
-            samtools_view_cmd = ["samtools", "view", "-bS", sam_file, "-o", bam_file]
-            samtools_sort_cmd = ["samtools", "sort", bam_file, "-o", sorted_bam_file]
-            samtools_index_cmd = ["samtools", "index", sorted_bam_file]
-
-            try:
-                subprocess.run(samtools_view_cmd, check=True, text=True, capture_output=True)
-                subprocess.run(samtools_sort_cmd, check=True, text=True, capture_output=True)
-                subprocess.run(samtools_index_cmd, check=True, text=True, capture_output=True)
-                bam_files.append(sorted_bam_file)
-            except subprocess.CalledProcessError as e:
-                print(f"Error processing SAM/BAM files: {e.stderr}")
-                return
+            print(f"Error indexing {sorted_bam_file}: {e.stderr}")
+            raise
 
         # Generate depth file
-
         depth_file = os.path.join(dir_path, "depth.txt")
-        jgi_cmd = ["jgi_summarize_bam_contig_depths", "--outputDepth", depth_file] + bam_files
+        jgi_cmd = ["jgi_summarize_bam_contig_depths", "--outputDepth", depth_file, sorted_bam_file]
         try:
             subprocess.run(jgi_cmd, check=True, text=True, capture_output=True)
         except subprocess.CalledProcessError as e:
             print("Error executing jgi_summarize_bam_contig_depths command:", e.stderr)
-            return
+            if os.path.exists(depth_file):
+                os.remove(depth_file)
+            raise
 
         # Run Metabat2
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
         metabat2_cmd = [
             "metabat2",
             "-i", contig_file,
             "-a", depth_file,
-            "-o", os.path.join(output_dir, "bin")
+            "-o", os.path.join(output_dir, "bin"),
+            "-t", str(cpus)
         ]
         try:
             result = subprocess.run(metabat2_cmd, check=True, text=True, capture_output=True)
             print("Metabat2 command executed successfully:", result.stdout)
         except subprocess.CalledProcessError as e:
             print("Error executing Metabat2 command:", e.stderr)
+            if not os.listdir(output_dir):
+                os.rmdir(output_dir)
+            raise
 
     def run_racon(self, read_file_path, sample_name):
         overlaps = f"{self.assembly_out}{sample_name}/{sample_name}_overlaps.paf"
@@ -244,7 +274,8 @@ class FunctionalRunner:
             print(cmd)
             os.system(cmd)
 
-    def run_medaka_consensus(self, assembly_file, read_file, dir_path, model="r941_min_high_g303"):
+    def run_medaka_consensus(self, assembly_file, read_file, dir_path, model="r941_min_high_g303", cpus=None):
+        cpus = cpus or self.cpus
         output_dir = os.path.join(dir_path, "medaka_corrected")
 
         # Create output directory if it doesn't exist
@@ -252,7 +283,7 @@ class FunctionalRunner:
             os.makedirs(output_dir)
 
         consensus_output = os.path.join(output_dir, "consensus.hdf")
-        print(self.cpus)
+        print(cpus)
 
         # Run Medaka consensus
         medaka_cmd = [
@@ -261,7 +292,7 @@ class FunctionalRunner:
             "-d", assembly_file,
             "-o", output_dir,
             "-m", model,
-            "-t", str(self.cpus)
+            "-t", str(cpus)
         ]
         try:
             print(f"medaka cmd: {medaka_cmd}")
@@ -269,6 +300,7 @@ class FunctionalRunner:
             print("Medaka consensus command executed successfully:", result.stdout)
         except subprocess.CalledProcessError as e:
             print("Error executing Medaka consensus command:", e.stderr)
+            raise
 
     def run_binning(self, sample_name):
         try:
@@ -311,12 +343,87 @@ class FunctionalRunner:
 
     # daa-meganizer -i $daa -mdb /abscratch/lucas/databases/megan-mapping-annotree-June-2021.db -t 48 --lcaCoveragePercent 51 -lg
     # read-extractor -i $daa -o $output_folder/extracted_reads/%t.fasta -c Taxonomy --frameShiftCorrect
-    def run_prokka(self, bin_folder_path):
-        fasta_files = glob.glob(f"{bin_folder_path}/*.fasta")
-        for fasta in fasta_files:
-            cmd = f"prokka --outdir {bin_folder_path}" \
-                  f" --force --prefix $(basename {fasta}) {fasta}  --cpus 0 --addgenes"
-            subprocess.call(cmd)
+    @staticmethod
+    def bin_files(bins_dir):
+        """
+        FASTA files of all bins in bins_dir (metabat2 writes .fa, renamed bins keep the ending)
+        """
+        return sorted(glob.glob(os.path.join(bins_dir, "*.fa")) + glob.glob(os.path.join(bins_dir, "*.fasta")))
+
+    @staticmethod
+    def bin_name(bin_file):
+        return os.path.basename(bin_file).removesuffix(".fasta").removesuffix(".fa")
+
+    def run_prokka_bin(self, bin_file, output_dir, cpus=None):
+        """
+        Annotates a single bin with prokka into output_dir.
+        return: path to the prokka tsv (with EC numbers) or None if prokka failed
+        """
+        prefix = self.bin_name(bin_file)
+        prokka_cmd = ["prokka", "--outdir", output_dir, "--force", "--prefix", prefix, "--cpus", str(cpus or self.cpus),
+                      "--addgenes", bin_file]
+        try:
+            subprocess.run(prokka_cmd, check=True, text=True, capture_output=True)
+        except (subprocess.CalledProcessError, FileNotFoundError) as e:
+            print(f"Error executing prokka for {bin_file}:", getattr(e, "stderr", e))
+            return None
+        return os.path.join(output_dir, f"{prefix}.tsv")
+
+    def run_prokka(self, bin_folder_path, cpus=None, output_dir=None):
+        """
+        Annotates all bins one after the other, every bin gets its own directory in output_dir. For annotating the
+        bins of a sample concurrently use the BinAnnotationQueue.
+        """
+        output_dir = output_dir or bin_folder_path
+        for fasta in self.bin_files(bin_folder_path):
+            self.run_prokka_bin(fasta, os.path.join(output_dir, self.bin_name(fasta)), cpus)
+
+    @staticmethod
+    def bin_taxonomy(bin_name):
+        """
+        Taxonomy shown by keggcharter for a bin, gtdb-tk renames the bins to their taxonomy (e.g. s__Escherichia_coli)
+        """
+        return re.sub(r"^[a-z]__", "", bin_name).replace('_', ' ').strip()
+
+    @staticmethod
+    def keggcharter_rows(prokka_tsv, bin_name):
+        data = pd.read_csv(prokka_tsv, sep='\t')
+        data["taxonomy"] = FunctionalRunner.bin_taxonomy(bin_name)
+        data["bin"] = bin_name
+        return data
+
+    @staticmethod
+    def append_keggcharter_input(keggcharter_tsv, prokka_tsv, bin_name):
+        """
+        Appends the annotation of a bin to the keggcharter input, so the input grows as bins are annotated instead
+        of being assembled from all prokka results at the end. Rows of an earlier annotation of the bin are replaced.
+        """
+        data = FunctionalRunner.keggcharter_rows(prokka_tsv, bin_name)
+        if os.path.exists(keggcharter_tsv):
+            FunctionalRunner.remove_from_keggcharter_input(keggcharter_tsv, bin_name)
+        data.to_csv(keggcharter_tsv, sep='\t', index=False, mode='a', header=not os.path.exists(keggcharter_tsv))
+
+    @staticmethod
+    def write_keggcharter_input(keggcharter_tsv, prokka_results):
+        """
+        Writes the keggcharter input from scratch, without prokka results only the header is written.
+        param(list): prokka_results as (prokka tsv, bin name) tuples
+        """
+        data = pd.concat([FunctionalRunner.keggcharter_rows(prokka_tsv, bin_name)
+                          for prokka_tsv, bin_name in prokka_results]) if prokka_results \
+            else pd.DataFrame(columns=KEGGCHARTER_COLUMNS)
+        tmp_file = f"{keggcharter_tsv}.tmp"
+        data.to_csv(tmp_file, sep='\t', index=False)
+        os.replace(tmp_file, keggcharter_tsv)
+
+    @staticmethod
+    def remove_from_keggcharter_input(keggcharter_tsv, bin_name):
+        """
+        Removes the rows of a bin from the keggcharter input, the file is only rewritten if it contains the bin.
+        """
+        merged = pd.read_csv(keggcharter_tsv, sep='\t', dtype=str)
+        if "bin" in merged.columns and (merged["bin"] == bin_name).any():
+            merged[merged["bin"] != bin_name].to_csv(keggcharter_tsv, sep='\t', index=False)
 
     """
     This method takes as input
@@ -325,27 +432,19 @@ class FunctionalRunner:
     """
 
     def create_keggcharter_input(self, path_to_prokka_output):
-        keggcharter_sheet = {'taxonomy': ['']}
-        df = pd.DataFrame(keggcharter_sheet)
-        df_list = []
-        df.to_csv(path_to_prokka_output + "keggcharter.tsv", sep='\t')
-        for tsv in glob.glob(f"{path_to_prokka_output}/*.tsv"):
+        """
+        Rebuilds keggcharter.tsv from all prokka results below path_to_prokka_output (one directory per bin). The
+        BinAnnotationQueue maintains the file incrementally, this is only needed to rebuild it from scratch.
+        """
+        keggcharter_tsv = os.path.join(path_to_prokka_output, "keggcharter.tsv")
+        prokka_results = []
+        for tsv in sorted(glob.glob(os.path.join(path_to_prokka_output, "*", "*.tsv"))):
             print(tsv)
-            data = pd.read_csv(tsv, sep='\t')
-            tax = tsv.split('.tsv')[0]
-            tax = tax.split('/')[-1]
-            try:
-                tax = tax[:tax.rfind('_')] + tax[tax.rfind('.'):]
-            except:
-                print()
-            tax = tax.replace('_', ' ')
-            if ".fasta" in tax:
-                tax = tax.removesuffix(".fasta")
-            print(tax)
-            data["taxonomy"] = tax
-            df_list.append(data)
-        df = pd.concat(df_list)
-        df.to_csv(path_to_prokka_output + "keggcharter.tsv", sep='\t')
+            prokka_results.append((tsv, os.path.basename(tsv).removesuffix(".tsv")))
+        if not prokka_results:
+            print(f"No prokka results found in {path_to_prokka_output}")
+            return
+        self.write_keggcharter_input(keggcharter_tsv, prokka_results)
 
     def env_exists(self, env_name):
         try:
@@ -383,18 +482,19 @@ class FunctionalRunner:
                     return line.split(':')[1].strip()
         raise ValueError(f"Could not find environment name in {yaml_path}")
 
-    def run_checkm2(self, bins_dir, dir_path):
+    def run_checkm2(self, bins_dir, dir_path, cpus=None):
+        cpus = cpus or self.cpus
         output_dir = os.path.join(dir_path, "checkm2_results")
 
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
+        # the bin files are passed one by one, -x only takes a single extension and bins can be .fa or .fasta
         checkm2_cmd = [
             "checkm2", "predict",
-            "-x", "fa",
-            "-i", bins_dir,
+            "-i", *self.bin_files(bins_dir),
             "-o", output_dir,
-            "--threads", str(self.cpus),
+            "--threads", str(cpus),
             "--force"
         ]
 
@@ -418,7 +518,8 @@ class FunctionalRunner:
             except subprocess.CalledProcessError as db_e:
                 print("Error downloading CheckM2 database or retrying the command:", db_e.stderr)
 
-    def run_bakta(self, input_file, output_dir):
+    def run_bakta(self, input_file, output_dir, cpus=None):
+        cpus = cpus or self.cpus
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
@@ -427,7 +528,7 @@ class FunctionalRunner:
             "--db", self.resources_path,
             "--input", input_file,
             "--output", output_dir,
-            "--threads", str(self.cpus)
+            "--threads", str(cpus)
         ]
 
         conda_prefix = subprocess.check_output(['conda', 'info', '--base'], text=True).strip()
@@ -449,7 +550,8 @@ class FunctionalRunner:
             except subprocess.CalledProcessError as db_e:
                 print("Error downloading CheckM2 database or retrying the command:", db_e.stderr)
 
-    def run_gtdb_tk(self, bins_dir, dir_path):
+    def run_gtdb_tk(self, bins_dir, dir_path, cpus=None):
+        cpus = cpus or self.cpus
         output_dir = os.path.join(dir_path, "gtdbtk_results")
 
         # Create output directory if it doesn't exist
@@ -461,7 +563,7 @@ class FunctionalRunner:
             "--genome_dir", bins_dir,
             "--out_dir", output_dir,
             "-x", ".fa",
-            "--cpus", str(self.cpus),
+            "--cpus", str(cpus),
             "--mash_db", "/mnt/disk2/db/release220/" #TODO: replace with correct PATH this was only quick fix for testing
         ]
         try:
@@ -470,6 +572,8 @@ class FunctionalRunner:
             print("GTDB-Tk command executed successfully:", result.stdout)
         except subprocess.CalledProcessError as e:
             print("Error executing GTDB-Tk command:", e.stderr)
+            # the bins are not classified, let the caller (the gtdbtk pipeline step) fail instead of going on
+            raise
 
         try:
             classification_file = os.path.join(output_dir, "gtdbtk.bac120.summary.tsv")
@@ -1,5 +1,6 @@
 import argparse
 import csv
+import glob
 import gzip
 import json
 import os
@@ -8,16 +9,24 @@ import numpy as np
 import logging
 
 from build_mmonitor_pyinstaller import ROOT
-from mmonitor.userside.FastqStatistics import FastqStatistics
+from lib import emu
+from src.mmonitor.userside.FastqStatistics import FastqStatistics, QCAccumulator
 
+from src.mmonitor.database import qc_encoding
 from src.mmonitor.database.django_db_interface import DjangoDBInterface
 from src.mmonitor.userside.CentrifugeRunner import CentrifugeRunner
 from src.mmonitor.userside.FunctionalRunner import FunctionalRunner
 from src.mmonitor.userside.EmuRunner import EmuRunner
+from src.mmonitor.userside.EmuScheduler import EmuScheduler
+from src.mmonitor.userside.FastqConcatenator import FastqConcatenator
+from src.mmonitor.userside.BinAnnotationQueue import BinAnnotationQueue
+from src.mmonitor.userside.PipelineExecutor import PipelineExecutor
+from src.mmonitor.userside.SequenceInput import SequenceInput
 from Bio import SeqIO
 import gzip
 from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
+from contextlib import ExitStack
 from datetime import date, datetime
 import argparse
 import csv
@@ -106,6 +115,50 @@ class MMonitorCMD:
         parser.add_argument('-b', '--barcodes', action="store_true",
                             help='Use barcode column from CSV for multiplexing.')
         parser.add_argument("--overwrite", action="store_true", help="Overwrite existing records. Defaults to False.")
+        parser.add_argument("--incremental", action="store_true",
+                            help="16s taxonomy only: align only files that were not processed in a previous run of "
+                                 "the sample and warm-start the abundance estimation from the stored results. "
+                                 "Use for live monitoring of a running flow cell.")
+        parser.add_argument("--align-jobs", type=int, default=1,
+                            help="16s taxonomy with --multicsv: number of samples aligned with minimap2 at the same "
+                                 "time. Default is 1.")
+        parser.add_argument("--align-threads", type=int, default=None,
+                            help="16s taxonomy with --multicsv: minimap2 threads per alignment. Defaults to all cores "
+                                 "divided by --align-jobs.")
+        parser.add_argument("--python-workers", type=int, default=1,
+                            help="16s taxonomy with --multicsv: additional worker processes for the scoring and "
+                                 "abundance estimation of samples, so that the EM of one sample overlaps the "
+                                 "alignment of the next. Default is 1.")
+        parser.add_argument("--em-shards", type=int, default=1,
+                            help="16s taxonomy: split the abundance estimation EM of a sample by read across this many "
+                                 "processes. Only faster with idle cores and large samples, the results are the same. "
+                                 "Default is 1.")
+        parser.add_argument("--eq-class-tolerance", type=float, default=None,
+                            help="16s taxonomy: collapse reads that align to the same species with log-likelihoods "
+                                 "equal up to this tolerance (e.g. 0.001) into equivalence classes before abundance "
+                                 "estimation. Faster on large samples, but the abundances become approximate. "
+                                 "Default is off.")
+        parser.add_argument("--em-scheme", choices=emu.EM_SCHEMES, default="squarem",
+                            help="16s taxonomy: 'squarem' accelerates the abundance estimation EM by extrapolating "
+                                 "over two steps, 'plain' runs the unaccelerated fixed-point iterations. Default is "
+                                 "squarem.")
+        parser.add_argument("--prune-margin", type=float, default=None,
+                            help="16s taxonomy: drop alignments whose log-likelihood is more than this below the "
+                                 "best alignment of the read before abundance estimation, e.g. 4.6 for a 100-fold "
+                                 "lower likelihood. The number of pruned alignments is printed. Default is off.")
+        parser.add_argument("--prune-report", action="store_true",
+                            help="16s taxonomy with --prune-margin: also estimate the abundances without pruning and "
+                                 "print the difference. Not available with --incremental.")
+        parser.add_argument("--input-mode", choices=SequenceInput.MODES, default="files",
+                            help="How the fastq chunk files of a sample are passed to the tools. 'files' passes the "
+                                 "file list to tools that accept multiple inputs and streams it through a named pipe "
+                                 "to all others, 'fifo' always streams through a named pipe, 'concat' writes a "
+                                 "concatenated fastq next to the raw data that is removed after the analysis. "
+                                 "Default is files.")
+        parser.add_argument("--no-cache", action="store_true",
+                            help="Always rerun alignment, abundance estimation and centrifuge instead of reusing "
+                                 "results of a previous run on the same reads, database and parameters from "
+                                 "pipeline_out/stage_cache.")
 
         # Quality control and update options
         parser.add_argument('-q', '--qc', action="store_true", help='Calculate QC statistics for input samples.')
@@ -155,23 +208,8 @@ class MMonitorCMD:
             print("No FASTQ files provided.")
             return
 
-        # Use a set to track unique files to avoid duplication
-        unique_files = set(file_paths)
-
-        with gzip.open(output_file, 'wb') as outfile:
-            for fastq_file in unique_files:
-                try:
-                    if fastq_file.endswith(".gz"):
-                        with gzip.open(fastq_file, 'rb') as infile:
-                            outfile.write(infile.read())
-                    else:
-                        with open(fastq_file, 'rb') as infile:
-                            outfile.write(infile.read())
-                except Exception as e:
-                    print(f"Error processing file {fastq_file}: {e}")
-                    continue
-
-        print(f"Concatenated {len(unique_files)} files into {output_file}")
+        # gzip members are byte-concatenated, plain files copied in the kernel, see FastqConcatenator
+        FastqConcatenator().concatenate(file_paths, output_file)
 
     def concatenate_files(self, files, sample_name):
         if not files:
@@ -180,7 +218,7 @@ class MMonitorCMD:
         file_extension = ".fastq.gz" if files[0].endswith(".gz") else ".fastq"
 
         # Ensure the first file has a valid directory path
-        first_file_dir = os.path.abspath(files[0])
+        first_file_dir = os.path.dirname(os.path.abspath(files[0]))
         if not first_file_dir:
             raise ValueError("The directory of the first file is invalid.")
 
@@ -214,16 +252,16 @@ class MMonitorCMD:
             print(f"Config path doesn't exist")
 
     def add_statistics(self, fastq_file, sample_name, project_name, subproject_name, sample_date, multi=True):
-        fastq_stats = FastqStatistics(fastq_file, multi=multi)
+        if isinstance(fastq_file, QCAccumulator):
+            # statistics were collected while the reads were streamed to the classifier
+            fastq_stats = FastqStatistics(statistics=fastq_file)
+        else:
+            fastq_stats = FastqStatistics(fastq_file, multi=multi)
         # Calculate statistics
-        fastq_stats.quality_statistics()
-        fastq_stats.read_lengths_statistics()
+        read_lengths_statistics = fastq_stats.read_lengths_statistics()
         quality_vs_lengths_data = fastq_stats.qualities_vs_lengths()
         gc_contents = fastq_stats.gc_content_per_sequence()
-        # qual_dist = fastq_stats.quality_score_distribution()
-        # q20_q30 = fastq_stats.q20_q30_scores()
-
-
+        q20_score, q30_score = fastq_stats.q20_q30_scores()
 
         data = {
             'sample_name': sample_name,
@@ -231,17 +269,23 @@ class MMonitorCMD:
             'subproject_id': subproject_name,
             'date': sample_date,
             'mean_gc_content': float(fastq_stats.gc_content()),  # Ensure float
-            'mean_read_length': float(np.mean(fastq_stats.lengths)),  # Convert with float()
-            'median_read_length': float(np.median(fastq_stats.lengths)),  # Convert with float()
-            'mean_quality_score': float(np.mean([np.mean(q) for q in fastq_stats.qualities])),  # Ensure float
-            'read_lengths': json.dumps(quality_vs_lengths_data['read_lengths'], cls=NumpyEncoder),
-            # Use custom encoder if needed
-            'avg_qualities': json.dumps(quality_vs_lengths_data['avg_qualities'], cls=NumpyEncoder),
-            # Use custom encoder if needed
+            'mean_read_length': float(read_lengths_statistics.get('mean_length', 0)),
+            'median_read_length': float(read_lengths_statistics.get('median_length', 0)),
+            'mean_quality_score': float(fastq_stats.mean_read_quality()),  # Ensure float
+            # per-read values of a random sample of reads and histograms over all reads, compressed float32/int64
+            # arrays instead of json lists (see qc_encoding)
+            'read_lengths': qc_encoding.encode_samples(quality_vs_lengths_data['read_lengths']),
+            'avg_qualities': qc_encoding.encode_samples(quality_vs_lengths_data['avg_qualities']),
             'number_of_reads': int(fastq_stats.number_of_reads()),  # Ensure int
             'total_bases_sequenced': int(fastq_stats.total_bases_sequenced()),  # Ensure int
-            'gc_contents_per_sequence': json.dumps(gc_contents, cls=NumpyEncoder)
-
+            'q20_score': float(q20_score),
+            'q30_score': float(q30_score),
+            'gc_contents_per_sequence': qc_encoding.encode_samples(gc_contents),
+            'read_length_histogram': qc_encoding.encode_histogram(
+                qc_encoding.rebin(fastq_stats.read_length_histogram(), qc_encoding.READ_LENGTH_BIN_WIDTH),
+                width=qc_encoding.READ_LENGTH_BIN_WIDTH),
+            # bin i holds the reads with a gc content that rounds to i percent
+            'gc_content_histogram': qc_encoding.encode_histogram(fastq_stats.gc_content_histogram(), start=-0.5),
         }
 
         self.django_db.send_sequencing_statistics(data)
@@ -294,6 +338,9 @@ class MMonitorCMD:
 
         if not os.path.exists(os.path.join(ROOT, "src", "resources", "emu_db", "taxonomy.tsv")):
             print("emu db not found")
+        self.emu_runner.input_mode = self.args.input_mode
+        self.emu_runner.collect_qc = self.args.qc
+        self.emu_runner.stage_cache.enabled = not self.args.no_cache
 
         if not self.args.multicsv:
             sample_name = str(self.args.sample)
@@ -311,17 +358,19 @@ class MMonitorCMD:
                 add_sample_to_databases(sample_name, project_name, subproject_name, sample_date)
                 return
 
-            self.emu_runner.run_emu(files, sample_name, self.args.minabundance)
+            self.run_emu(files, sample_name)
 
             add_sample_to_databases(sample_name, project_name, subproject_name, sample_date)
             if self.args.qc:
-                self.add_statistics(self.emu_runner.concat_file_name, sample_name, project_name, subproject_name,
-                                    sample_date)
+                self.add_statistics(self.emu_runner.qc_statistics or self.emu_runner.concat_file_name, sample_name,
+                                    project_name, subproject_name, sample_date)
                 print("adding statistics")
 
         else:
             self.load_from_csv()
             print("Processing multiple samples")
+            samples = []
+            sample_info = {}
             for index, file_path_list in enumerate(self.multi_sample_input["file_paths_lists"]):
                 files = file_path_list
                 sample_name = self.multi_sample_input["sample_names"][index]
@@ -338,15 +387,24 @@ class MMonitorCMD:
                     print("Update parameter specified. Will only update results from file.")
                     add_sample_to_databases(sample_name, project_name, subproject_name, sample_date)
                     continue
+                samples.append((sample_name, files))
+                sample_info[sample_name] = (project_name, subproject_name, sample_date)
 
-                self.emu_runner.run_emu(files, sample_name, self.args.minabundance)
+            # upload and QC of a finished sample run here while the scheduler keeps aligning the next samples
+            def on_sample_done(sample_name, qc_input):
+                project_name, subproject_name, sample_date = sample_info[sample_name]
                 add_sample_to_databases(sample_name, project_name, subproject_name, sample_date)
-                print(f"Finished processing sample {index+1} of {len(file_path_list)}")
                 if self.args.qc:
-                    self.add_statistics(self.emu_runner.concat_file_name, sample_name, project_name, subproject_name,
-                                        sample_date)
+                    self.add_statistics(qc_input, sample_name, project_name, subproject_name, sample_date)
                     print("adding statistics")
 
+            scheduler = EmuScheduler(self.emu_runner, self.args.align_jobs, self.args.align_threads,
+                                     self.args.python_workers)
+            failed = scheduler.run(samples, self.args.minabundance, self.args.incremental, on_sample_done,
+                                   self.em_options())
+            if failed:
+                print(f"emu failed for {len(failed)} samples: {', '.join(failed)}")
+
         # calculate QC statistics if qc argument is given by user
 
         # emu_out_path = f"{ROOT}/src/resources/pipeline_out/subset/"
@@ -359,6 +417,24 @@ class MMonitorCMD:
 
         print("Analysis complete. You can start monitoring now.")
 
+    def run_emu(self, files, sample_name):
+        if isinstance(files, str) and os.path.isdir(files):
+            files = self.get_files_from_folder(files)
+        if self.args.incremental:
+            self.emu_runner.run_emu_incremental(files, sample_name, self.args.minabundance, **self.em_options())
+        else:
+            self.emu_runner.run_emu(files, sample_name, self.args.minabundance, **self.em_options())
+
+    def em_options(self):
+        """
+        Keyword arguments for EmuRunner.run_emu and run_emu_incremental from the command line options.
+        """
+        options = {"eq_class_tolerance": self.args.eq_class_tolerance, "em_scheme": self.args.em_scheme,
+                   "prune_margin": self.args.prune_margin, "em_shards": self.args.em_shards}
+        if not self.args.incremental:
+            options["prune_report"] = self.args.prune_report
+        return options
+
     def load_from_csv(self):
         file_path = self.args.multicsv
 
@@ -463,6 +539,9 @@ class MMonitorCMD:
 
         if not os.path.exists(os.path.join(ROOT, "src", "resources", "dec_22.1.cf")):
             print("centrifuge db not found")
+        self.centrifuge_runner.input_mode = self.args.input_mode
+        self.centrifuge_runner.collect_qc = self.args.qc
+        self.centrifuge_runner.stage_cache.enabled = not self.args.no_cache
 
         if not self.args.multicsv:
             sample_name = str(self.args.sample)
@@ -483,26 +562,16 @@ class MMonitorCMD:
                 print("Update parameter specified. Will only update results from file.")
                 add_sample_to_databases(sample_name, project_name, subproject_name, sample_date)
                 return
-            # concat_file_name = f"{os.path.dirname(files[0])}/{sample_name}_concatenated.fastq.gz"
-            if files[0].endswith(".gz"):
-                concat_file_name = f"{os.path.dirname(files[0])}/{sample_name}_concatenated.fastq.gz"
-                CentrifugeRunner.concatenate_gzipped_files(files,concat_file_name)
-            else:
-                concat_file_name = f"{os.path.dirname(files[0])}/{sample_name}_concatenated.fastq"
-                CentrifugeRunner.concatenate_fastq_fast(files, concat_file_name, False)
-
-            self.centrifuge_runner.run_centrifuge(concat_file_name, sample_name, cent_db_path)
+            self.centrifuge_runner.run_centrifuge(files, sample_name, cent_db_path)
             add_sample_to_databases(sample_name, project_name, subproject_name, sample_date)
             if self.args.qc:
-                self.add_statistics(self.centrifuge_runner.concat_file_name, sample_name, project_name, subproject_name,
-                                    sample_date)
+                self.add_statistics(self.centrifuge_runner.qc_statistics or self.centrifuge_runner.concat_file_name,
+                                    sample_name, project_name, subproject_name, sample_date)
                 print("adding statistics")
-            os.remove(concat_file_name)
 
         else:
             self.load_from_csv()
             print("Processing multiple samples")
-            concat_files_list = []
             all_file_paths = []
             sample_names_to_process = []
             project_names = []
@@ -510,7 +579,6 @@ class MMonitorCMD:
             sample_dates = []
             for index, file_path_list in enumerate(self.multi_sample_input["file_paths_lists"]):
                 files = file_path_list
-                all_file_paths.append(files)
                 sample_name = self.multi_sample_input["sample_names"][index]
                 print(f"Analyzing amplicon data for sample {sample_name}.")
                 # when a sample is already in the database and user does not want to overwrite quit now
@@ -520,13 +588,8 @@ class MMonitorCMD:
                             f"Sample {sample_name} already in DB and overwrite not specified, continue with next sample...")
                         continue
 
+                all_file_paths.append(files)
                 sample_names_to_process.append(sample_name)
-                if files[index].endswith(".gz"):
-                    concat_file_name = f"{os.path.dirname(files[index])}/{sample_name}_concatenated.fastq.gz"
-                else:
-                    concat_file_name = f"{os.path.dirname(files[index])}/{sample_name}_concatenated.fastq"
-                concat_files_list.append(concat_file_name)
-
 
                 project_name = self.multi_sample_input["project_names"][index]
                 subproject_name = self.multi_sample_input["subproject_names"][index]
@@ -536,29 +599,43 @@ class MMonitorCMD:
                 subproject_names.append(subproject_name)
                 sample_dates.append(sample_date)
 
+            # samples whose reads and database didn't change since the last run are taken from the stage cache
+            stage_cache = self.centrifuge_runner.stage_cache
+            cache_keys = {}
             for idx, files in enumerate(all_file_paths):
-                sample_name = self.multi_sample_input["sample_names"][idx]
-                print(f"Analyzing amplicon data for sample {sample_name}.")
-                total_files = len(all_file_paths)
-                print(f"Concatenating fastq files... ({idx + 1}/{total_files})")
-                if files[idx].endswith(".gz"):
-                    concat_file_name = f"{os.path.dirname(files[idx])}/{sample_name}_concatenated.fastq.gz"
-                    CentrifugeRunner.concatenate_gzipped_files(files,concat_file_name)
-                else:
-                    concat_file_name = f"{os.path.dirname(files[idx])}/{sample_name}_concatenated.fastq"
-                    CentrifugeRunner.concatenate_fastq_fast(files, concat_file_name, False)
-                concat_files_list.append(concat_file_name)
-            centrifuge_tsv_path = os.path.join(ROOT, "src", "resources", "centrifuge.tsv")
-            print(f"Creating centrifuge tsv...")
-            CentrifugeRunner.create_centrifuge_input_file(self.multi_sample_input["sample_names"],
-                                                                concat_files_list,
-                                                                centrifuge_tsv_path)
-            print(f"Running centrifuge for multiple samples from tsv {centrifuge_tsv_path}...")
-            CentrifugeRunner.run_centrifuge_multi_sample(centrifuge_tsv_path, cent_db_path)
-
-            print(f"Make kraken report from centrifuge reports...")
-
-            CentrifugeRunner.make_kraken_report_from_tsv(centrifuge_tsv_path, cent_db_path)
+                sample_name = sample_names_to_process[idx]
+                cache_key = self.centrifuge_runner.centrifuge_cache_key(files, cent_db_path)
+                if not stage_cache.restore("centrifuge", cache_key,
+                                           CentrifugeRunner.centrifuge_outputs(sample_name), f"{sample_name} "):
+                    cache_keys[idx] = cache_key
+
+            # QC statistics collected while centrifuge read the samples
+            sample_reads = {}
+            if cache_keys:
+                centrifuge_tsv_path = os.path.join(ROOT, "src", "resources", "centrifuge.tsv")
+                # the sample sheet takes one read file per sample, every sample gets a fifo streaming its chunk files
+                # (or a concatenated file in concat mode), centrifuge reads them one after the other
+                with ExitStack() as stack:
+                    read_files = []
+                    for idx in cache_keys:
+                        reads = stack.enter_context(SequenceInput(all_file_paths[idx], sample_names_to_process[idx],
+                                                                  self.args.input_mode, collect_qc=self.args.qc))
+                        sample_reads[idx] = reads
+                        read_files.append(stack.enter_context(reads.as_single_file()))
+                    print(f"Creating centrifuge tsv...")
+                    CentrifugeRunner.create_centrifuge_input_file([sample_names_to_process[idx] for idx in cache_keys],
+                                                                  read_files, centrifuge_tsv_path)
+                    print(f"Running centrifuge for multiple samples from tsv {centrifuge_tsv_path}...")
+                    centrifuge_ok = CentrifugeRunner.run_centrifuge_multi_sample(centrifuge_tsv_path, cent_db_path)
+
+                print(f"Make kraken report from centrifuge reports...")
+
+                CentrifugeRunner.make_kraken_report_from_tsv(centrifuge_tsv_path, cent_db_path)
+                # store only refuses samples without outputs, a failed run may have left partial ones
+                if centrifuge_ok:
+                    for idx, cache_key in cache_keys.items():
+                        stage_cache.store("centrifuge", cache_key,
+                                          CentrifugeRunner.centrifuge_outputs(sample_names_to_process[idx]))
 
 
             print(f"Adding all samples to database...")
@@ -568,34 +645,85 @@ class MMonitorCMD:
                 # calculate QC statistics if qc argument is given by user
                 if self.args.qc:
                     print(f"Adding statistics for sample: {sample}...")
-                    print(f"Loading files: {file_paths}")
-                    print(f"concat files list {concat_files_list}")
-
-
-                    self.add_statistics(concat_files_list[idx], sample_names_to_process[idx], project_names[idx],
+                    qc_statistics = sample_reads[idx].qc_statistics if idx in sample_reads else None
+                    self.add_statistics(qc_statistics or all_file_paths[idx], sample_names_to_process[idx],
+                                        project_names[idx],
                                         subproject_names[idx],
                                         sample_dates[idx])
-            print(f"Removing concatenated files...")
-            for concat_file in concat_files_list:
-                os.remove(concat_file)
-
-    def assembly_pipeline(self, s_name, p_name, sp_name, s_date, fils):
-        concat_file_name = self.concatenate_files(fils, s_name)
-        print(concat_file_name)
-        contig_file_path = self.functional_runner.run_flye(concat_file_name, s_name, True, True)
-        out_path = os.path.join(self.pipeline_out, s_name)
-        self.functional_runner.run_medaka_consensus(contig_file_path, concat_file_name, out_path)
 
-        print(f" contig_file_path: {contig_file_path}")
-        print(f" concat_file_path: {concat_file_name}")
-        print(f" out_path: {out_path}")
-        self.functional_runner.run_metabat2_pipeline(contig_file_path, concat_file_name, out_path)
+    def assembly_pipeline(self, s_name, p_name, sp_name, s_date, fils, functional=False):
+        self.assembly_pipeline_samples([(s_name, fils)], functional)
+
+    def assembly_pipeline_samples(self, samples, functional=False):
+        """
+        Runs assembly, correction, binning and bin taxonomy (and with functional=True the bin annotation steps) for
+        all samples in one PipelineExecutor, so steps of different samples run concurrently. Steps completed in a
+        previous run with unchanged inputs are skipped.
+        param(list): samples as (sample_name, files) tuples
+        return: list of failed steps
+        """
+        executor = PipelineExecutor(os.path.join(self.pipeline_out, "assembly_pipeline_state.json"))
+        with ExitStack() as stack:
+            for s_name, fils in samples:
+                reads = stack.enter_context(SequenceInput(fils, s_name, self.args.input_mode))
+                self.add_assembly_steps(executor, reads, s_name, functional)
+            failed = executor.run()
+        if failed:
+            print(f"Assembly pipeline steps failed or not run: {', '.join(failed)}")
+        return failed
+
+    def add_assembly_steps(self, executor, reads, s_name, functional=False):
+        """
+        Declares the pipeline steps of a sample with their input and output files. medaka runs next to binning (the
+        bins are made from the flye assembly). After gtdb-tk has renamed the bins, checkm2, bakta and prokka annotate
+        them concurrently in a BinAnnotationQueue.
+        """
+        runner = self.functional_runner
+        out_path = os.path.join(self.pipeline_out, s_name)
+        contig_file_path = os.path.join(out_path, "assembly.fasta")
         bins_dir = os.path.join(out_path, "metabat_bins")
-        bakta_dir = os.path.join(out_path, "bakta_results")
+        all_cpus = executor.cpus
+        half_cpus = max(1, executor.cpus // 2)
+
+        def flye(cpus):
+            # flye reads its input several times, it never gets a fifo
+            with reads.as_files(single_pass=False) as read_files:
+                runner.run_flye(read_files, s_name, True, True, cpus=cpus)
+
+        def medaka(cpus):
+            with reads.as_single_file() as read_file:
+                runner.run_medaka_consensus(contig_file_path, read_file, out_path, cpus=cpus)
+
+        def metabat2(cpus):
+            with reads.as_files() as read_files:
+                runner.run_metabat2_pipeline(contig_file_path, read_files, out_path, cpus=cpus)
+
+        executor.add_step(f"{s_name}/flye", flye, reads.files, [contig_file_path], all_cpus)
+        executor.add_step(f"{s_name}/medaka", medaka, reads.files + [contig_file_path],
+                          [os.path.join(out_path, "medaka_corrected", "consensus.fasta")], half_cpus)
+        executor.add_step(f"{s_name}/metabat2", metabat2, reads.files + [contig_file_path],
+                          [os.path.join(out_path, "depth.txt"), bins_dir], half_cpus)
+        # the summary is only written by a successful gtdbtk run, the results directory is created before it starts
+        gtdbtk_summary = os.path.join(out_path, "gtdbtk_results", "gtdbtk.bac120.summary.tsv")
+        executor.add_step(f"{s_name}/gtdbtk", lambda cpus: runner.run_gtdb_tk(bins_dir, out_path, cpus=cpus),
+                          [bins_dir], [gtdbtk_summary], all_cpus)
+        if not functional:
+            return
+
+        annotation_queue = BinAnnotationQueue(runner, bins_dir, out_path)
+        kegg_out = os.path.join(out_path, "keggcharter_results")
 
-        # self.functional_runner.run_checkm2(bins_dir, out_path)
-        # self.functional_runner.run_bakta(contig_file_path, bakta_dir)
-        self.functional_runner.run_gtdb_tk(bins_dir, out_path)
+        def annotation(cpus):
+            # bins are annotated concurrently, a rerun only annotates bins that failed or changed
+            failed = annotation_queue.run(cpus)
+            if failed:
+                raise RuntimeError(f"annotation failed for {', '.join(failed)}")
+
+        executor.add_step(f"{s_name}/annotation", annotation, [bins_dir], [annotation_queue.keggcharter_tsv],
+                          all_cpus, after=[f"{s_name}/gtdbtk"])
+        executor.add_step(f"{s_name}/keggcharter",
+                          lambda cpus: runner.run_keggcharter(kegg_out, annotation_queue.keggcharter_tsv),
+                          [annotation_queue.keggcharter_tsv], [kegg_out], 1)
 
 class OutputLogger:
     def __init__(self, log_file_path):
@@ -655,8 +783,9 @@ if __name__ == "__main__":
             command_runner.taxonomy_nanopore_wgs()
         if command_runner.args.analysis == "stats":
             command_runner.update_only_statistics()
-        if command_runner.args.analysis == "assembly":
-            command_runner.assembly_pipeline(sample_name, project_name, subproject_name, sample_date, files)
+        if command_runner.args.analysis in ("assembly", "functional"):
+            command_runner.assembly_pipeline(sample_name, project_name, subproject_name, sample_date, files,
+                                             command_runner.args.analysis == "functional")
 
     command_runner = MMonitorCMD()
     print(command_runner.args)
@@ -673,18 +802,14 @@ if __name__ == "__main__":
         subproject_name = str(command_runner.args.subproject)
         sample_date = command_runner.args.date if command_runner.args.date else datetime.now().strftime('%Y-%m-%d')
 
+        # the analyses read the chunk files through SequenceInput, no concatenated copy is written here
         files = command_runner.get_files_from_folder(command_runner.args.input, False)
-        concat_file_name = command_runner.concatenate_files(files, sample_name)
-
-        print(f" contig_file_path: {contig_file_path}")
-        print(f" concat_file_path: {concat_file_name}")
-        print(f" out_path: {out_path}")
         run_user_choice(sample_name, project_name, subproject_name, sample_date, files)
     else:
         command_runner.load_from_csv()
         print("Processing multiple samples")
-        concat_files_list = []
         all_file_paths = []
+        samples = []
         sample_names_to_process = []
         project_names = []
         subproject_names = []
@@ -702,11 +827,7 @@ if __name__ == "__main__":
                     continue
 
             sample_names_to_process.append(sample_name)
-            if files[index].endswith(".gz"):
-                concat_file_name = f"{os.path.dirname(files[index])}/{sample_name}_concatenated.fastq.gz"
-            else:
-                concat_file_name = f"{os.path.dirname(files[index])}/{sample_name}_concatenated.fastq"
-            concat_files_list.append(concat_file_name)
+            samples.append((sample_name, files))
 
             project_name = command_runner.multi_sample_input["project_names"][index]
             subproject_name = command_runner.multi_sample_input["subproject_names"][index]
@@ -716,24 +837,17 @@ if __name__ == "__main__":
             subproject_names.append(subproject_name)
             sample_dates.append(sample_date)
 
-        for idx, files in enumerate(all_file_paths):
-            sample_name = command_runner.multi_sample_input["sample_names"][idx]
-            total_files = len(all_file_paths)
-            print(f"Concatenating fastq files... ({idx + 1}/{total_files})")
-            if files[idx].endswith(".gz"):
-                concat_file_name = f"{os.path.dirname(files[idx])}/{sample_name}_concatenated.fastq.gz"
-                CentrifugeRunner.concatenate_gzipped_files(files, concat_file_name)
-            else:
-                concat_file_name = f"{os.path.dirname(files[idx])}/{sample_name}_concatenated.fastq"
-                CentrifugeRunner.concatenate_fastq_fast(files, concat_file_name, False)
-            concat_files_list.append(concat_file_name)
-        for idx, sample in enumerate(sample_names_to_process):
-            run_user_choice(command_runner.multi_sample_input["sample_names"][idx],
-                            command_runner.multi_sample_input["project_names"][idx],
-                            command_runner.multi_sample_input["subproject_names"][idx],
-                            command_runner.multi_sample_input["dates"][idx],
-                            files
-                            )
+        if command_runner.args.analysis in ("assembly", "functional"):
+            # all samples go into one pipeline, so that steps of different samples run concurrently
+            command_runner.assembly_pipeline_samples(samples, command_runner.args.analysis == "functional")
+        else:
+            for idx, sample in enumerate(sample_names_to_process):
+                run_user_choice(command_runner.multi_sample_input["sample_names"][idx],
+                                command_runner.multi_sample_input["project_names"][idx],
+                                command_runner.multi_sample_input["subproject_names"][idx],
+                                command_runner.multi_sample_input["dates"][idx],
+                                files
+                                )
 
 
 
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# func is called with the number of cpus allotted to the step, inputs and outputs are files or directories
+PipelineStep = namedtuple("PipelineStep", ["name", "func", "inputs", "outputs", "cpus", "after"])
+
+
+class PipelineExecutor:
+    """
+    Runs the steps of the assembly/binning/annotation pipeline as a DAG. A step depends on all steps that produce
+    one of its inputs and on the steps listed in after (for steps that modify files in place, e.g. gtdb-tk renaming
+    the bins). Independent steps, also of different samples, run concurrently as long as their cpus fit into the
+    cpu budget of the executor. Every step gets min(step.cpus, budget) cpus, ready steps are started in the order
+    they were added.
+
+    When a step finishes and all its outputs exist, its name, signature and the fingerprint of its inputs (path,
+    size, mtime of all files) are written to the state file. On the next run a step is skipped if it is recorded
+    with the same signature, its outputs exist and its inputs didn't change, so a crashed or interrupted pipeline
+    resumes after the last completed steps. A step that raises or doesn't create or update all its outputs fails
+    (outputs of an earlier run that the step left unchanged don't count), the steps depending on it are not run,
+    all others are.
+    """
+
+    def __init__(self, state_file, cpus=None):
+        self.state_file = state_file
+        self.cpus = cpus or multiprocessing.cpu_count()
+        self.steps = {}
+        self.state_lock = threading.Lock()
+
+    def add_step(self, name, func, inputs=(), outputs=(), cpus=1, after=()):
+        if name in self.steps:
+            raise ValueError(f"Pipeline step {name} is defined twice")
+        self.steps[name] = PipelineStep(name, func, list(inputs), list(outputs), max(1, min(cpus, self.cpus)),
+                                        list(after))
+
+    def dependencies(self):
+        """
+        return: dict step name -> set of names of the steps it depends on
+        """
+        producers = {os.path.abspath(output): step.name for step in self.steps.values() for output in step.outputs}
+        dependencies = {}
+        for step in self.steps.values():
+            depends_on = {producers[os.path.abspath(i)] for i in step.inputs if os.path.abspath(i) in producers}
+            for name in step.after:
+                if name not in self.steps:
+                    raise ValueError(f"Pipeline step {step.name} depends on unknown step {name}")
+                depends_on.add(name)
+            depends_on.discard(step.name)
+            dependencies[step.name] = depends_on
+        return dependencies
+
+    @staticmethod
+    def fingerprint(paths):
+        """
+        Path, size and mtime of all files in paths (directories recursively).
+        """
+        fingerprint = []
+        for path in paths:
+            if os.path.isdir(path):
+                for dir_path, _, file_names in sorted(os.walk(path)):
+                    for file_name in sorted(file_names):
+                        file_path = os.path.join(dir_path, file_name)
+                        stat = os.stat(file_path)
+                        fingerprint.append([file_path, stat.st_size, stat.st_mtime_ns])
+            elif os.path.exists(path):
+                stat = os.stat(path)
+                fingerprint.append([path, stat.st_size, stat.st_mtime_ns])
+            else:
+                fingerprint.append([path, None, None])
+        return hashlib.sha256(json.dumps(fingerprint).encode()).hexdigest()
+
+    @staticmethod
+    def signature(step):
+        return hashlib.sha256(json.dumps([step.name, step.inputs, step.outputs]).encode()).hexdigest()
+
+    def load_state(self):
+        if not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file) as infile:
+                return json.load(infile)
+        except ValueError:
+            print(f"Could not read pipeline state {self.state_file}, all steps will be run")
+            return {}
+
+    def save_step(self, state, step):
+        with self.state_lock:
+            state[step.name] = {"signature": self.signature(step), "inputs": self.fingerprint(step.inputs),
+                                "finished": time.strftime("%Y-%m-%d %H:%M:%S")}
+            os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok=True)
+            tmp_file = f"{self.state_file}.tmp"
+            with open(tmp_file, 'w') as outfile:
+                json.dump(state, outfile, indent=1)
+            os.replace(tmp_file, self.state_file)
+
+    def is_up_to_date(self, state, step):
+        record = state.get(step.name)
+        return (record is not None
+                and record["signature"] == self.signature(step)
+                and all(os.path.exists(output) for output in step.outputs)
+                and record["inputs"] == self.fingerprint(step.inputs))
+
+    def run_step(self, step):
+        print(f"Running pipeline step {step.name} with {step.cpus} cpus")
+        start = time.time()
+        # outputs of an earlier run that exist before the step runs must be rewritten by it, tools that only print
+        # their errors would otherwise leave the old outputs behind and the step would be recorded as done
+        previous = {output: self.fingerprint([output]) for output in step.outputs if os.path.exists(output)}
+        step.func(step.cpus)
+        missing = [output for output in step.outputs if not os.path.exists(output)]
+        if missing:
+            raise RuntimeError(f"outputs {', '.join(missing)} were not created")
+        unchanged = [output for output, fingerprint in previous.items() if self.fingerprint([output]) == fingerprint]
+        if unchanged:
+            raise RuntimeError(f"outputs {', '.join(unchanged)} were not updated")
+        print(f"Finished pipeline step {step.name} in {time.time() - start:.0f} s")
+
+    def run(self):
+        """
+        Runs all steps that are not up to date.
+        return: list of names of the steps that failed or were not run because a dependency failed
+        """
+        dependencies = self.dependencies()
+        state = self.load_state()
+        pending = dict(self.steps)
+        done, failed = set(), []
+        running = {}
+        free_cpus = self.cpus
+        with ThreadPoolExecutor(max_workers=max(1, len(self.steps))) as pool:
+            while pending or running:
+                blocked = False
+                for name, step in list(pending.items()):
+                    if dependencies[name] & set(failed):
+                        print(f"Skipping pipeline step {name}, a step it depends on failed")
+                        failed.append(name)
+                        del pending[name]
+                    elif dependencies[name] <= done:
+                        # all dependencies of the step are complete at this point, so its inputs are final
+                        if self.is_up_to_date(state, step):
+                            print(f"Skipping pipeline step {name}, outputs are up to date")
+                            done.add(name)
+                            del pending[name]
+                        elif step.cpus <= free_cpus and not blocked:
+                            free_cpus -= step.cpus
+                            running[pool.submit(self.run_step, step)] = step
+                            del pending[name]
+                        else:
+                            # ready steps start in the order they were added, later steps don't overtake a step
+                            # waiting for cpus, so large steps (flye of the next sample) are not starved
+                            blocked = True
+                if any(dependencies[name] <= done for name in pending) and not running:
+                    # a skipped step completed dependencies of others, schedule them before waiting
+                    continue
+                if not running:
+                    if pending:
+                        # remaining steps depend on steps that can never run
+                        failed += list(pending)
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    free_cpus += step.cpus
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"Pipeline step {step.name} failed: {e}")
+                        failed.append(step.name)
+                        continue
+                    self.save_step(state, step)
+                    done.add(step.name)
+        return failed
@@ -0,0 +1,211 @@
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import partial
+
+from src.mmonitor.userside.FastqConcatenator import FastqConcatenator
+from src.mmonitor.userside.FastqStatistics import CHUNK_SIZE, QCStream
+
+# the kernel limits a single command line argument to 128 KiB (MAX_ARG_STRLEN), longer joined lists go through a fifo
+MAX_ARGUMENT_LENGTH = 128 * 1024 - 1024
+
+
+class SequenceInput:
+    """
+    Input layer between the sequencing chunk files of a sample and the external tools, so that no concatenated
+    copy of the reads has to be written next to the raw data.
+    Modes:
+        files:  tools that accept multiple inputs (minimap2, centrifuge -U a,b,c, flye) get the chunk files as they
+                are, tools that only read a single file get a fifo
+        fifo:   every tool gets a named pipe into which a writer thread streams the chunks in order
+        concat: opt-in fallback, the chunks are concatenated into <sample>_concatenated.fastq(.gz) next to the raw
+                data once and the file is removed again when the SequenceInput is closed (unless keep_concatenated)
+    A fifo can only be read once from start to end, tools that read their input multiple times (flye) use
+    as_files(single_pass=False), which never yields a fifo.
+    With collect_qc the reads are ingested in a single pass: every chunk is decompressed once and the plain reads
+    go to the tool (through a fifo, also in files mode, or into the concatenated file) and into a QCStream at the
+    same time. After the first complete pass qc_statistics holds the QCAccumulator of the sample, so the QC
+    statistics don't need a second pass over the (gzipped) chunks.
+    Use as context manager:
+        with SequenceInput(files, sample_name) as reads:
+            with reads.as_files(separator=",") as read_arg: ...
+            with reads.as_single_file() as read_file: ...
+    """
+    MODES = ("files", "fifo", "concat")
+
+    def __init__(self, files, sample_name, mode="files", keep_concatenated=False, collect_qc=False):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown input mode {mode}, choose from {', '.join(self.MODES)}")
+        if isinstance(files, str):
+            files = [files]
+        # remove concatenated files of earlier runs from the file list to avoid reading reads twice
+        self.files = [f for f in dict.fromkeys(files) if "concatenated" not in os.path.basename(f)]
+        if not self.files:
+            raise ValueError(f"No sequencing files for sample {sample_name}")
+        self.sample_name = sample_name
+        # named pipes are not available on windows, concatenate there
+        self.mode = mode if hasattr(os, "mkfifo") else "concat"
+        self.keep_concatenated = keep_concatenated
+        self.concat_file_name = None
+        self.collect_qc = collect_qc
+        self.qc_statistics = None
+        # steps of the PipelineExecutor may ask for the concatenated file at the same time
+        self.concat_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.concat_file_name and not self.keep_concatenated and os.path.exists(self.concat_file_name):
+            os.remove(self.concat_file_name)
+            print(f"Removed {self.concat_file_name}")
+        self.concat_file_name = None
+
+    def suffix(self):
+        """
+        File ending for a single file holding all reads. gzip members can be streamed as they are if all chunks are
+        gzipped and no QC is collected, otherwise the gzipped chunks are decompressed and the output is plain.
+        """
+        first_file = self.files[0]
+        base, ext = os.path.splitext(first_file[:-3] if first_file.endswith(".gz") else first_file)
+        ext = ext or ".fastq"
+        if not self.collect_qc and all(FastqConcatenator.is_gzipped(f) for f in self.files):
+            return f"{ext}.gz"
+        return ext
+
+    @contextmanager
+    def as_files(self, separator=None, single_pass=True):
+        """
+        Input for tools that accept multiple files. Yields the list of files or, if a separator is given, a single
+        argument with the files joined by it. Joined lists that would exceed the argument length limit of the kernel
+        are replaced by a fifo. Tools that read their input more than once (single_pass=False) never get a fifo, they
+        get the file list in fifo mode and the concatenated file if the list is too long. Single pass tools get a
+        fifo with collect_qc, so the QC statistics are collected while they read.
+        """
+        if self.mode == "concat":
+            yield self.concatenated() if separator is not None else [self.concatenated()]
+            return
+        if (self.mode == "files" and not self.collect_qc) or not single_pass:
+            if separator is None:
+                yield list(self.files)
+                return
+            joined = separator.join(self.files)
+            if len(joined) <= MAX_ARGUMENT_LENGTH:
+                yield joined
+                return
+            if not single_pass:
+                yield self.concatenated()
+                return
+        with self.as_single_file() as read_file:
+            yield read_file if separator is not None else [read_file]
+
+    @contextmanager
+    def as_single_file(self):
+        """
+        Input for tools that only read a single file. Yields a single chunk file as is, the concatenated file in
+        concat mode and a fifo otherwise.
+        """
+        if self.mode == "concat":
+            yield self.concatenated()
+        elif len(self.files) == 1 and not self.collect_qc:
+            yield self.files[0]
+        else:
+            with self.fifo() as fifo_path:
+                yield fifo_path
+
+    def concatenated(self):
+        with self.concat_lock:
+            if self.concat_file_name is None:
+                concat_file_name = os.path.join(os.path.dirname(os.path.abspath(self.files[0])),
+                                                f"{self.sample_name}_concatenated{self.suffix()}")
+                if not os.path.exists(concat_file_name):
+                    if self.collect_qc:
+                        self.qc_statistics = self.ingest(concat_file_name)
+                    else:
+                        FastqConcatenator().concatenate(self.files, concat_file_name)
+                self.concat_file_name = concat_file_name
+            return self.concat_file_name
+
+    @contextmanager
+    def fifo(self):
+        """
+        Creates a named pipe in a temporary directory and streams the chunk files into it on a writer thread. The
+        writer blocks until the tool opens the pipe. If the tool exits without reading everything (or without
+        opening the pipe at all) the writer is released when the context is left.
+        """
+        fifo_dir = tempfile.mkdtemp(prefix="mmonitor_")
+        fifo_path = os.path.join(fifo_dir, f"{self.sample_name}_reads{self.suffix()}")
+        os.mkfifo(fifo_path)
+        errors = []
+
+        def write_chunks():
+            try:
+                if self.collect_qc:
+                    # later passes (a tool reading the reads again) only stream, the statistics of the first are kept
+                    statistics = self.ingest(fifo_path, qc=self.qc_statistics is None)
+                    self.qc_statistics = self.qc_statistics or statistics
+                else:
+                    FastqConcatenator().concatenate(self.files, fifo_path)
+            except BrokenPipeError:
+                errors.append(f"Reader of {fifo_path} exited before all reads of {self.sample_name} were read")
+            except OSError as e:
+                errors.append(f"Error streaming reads of {self.sample_name} into {fifo_path}: {e}")
+
+        writer = threading.Thread(target=write_chunks, daemon=True)
+        writer.start()
+        try:
+            yield fifo_path
+        finally:
+            writer.join(timeout=0.1)
+            while writer.is_alive():
+                # open and close the read end, a writer still waiting for a reader gets a broken pipe and returns
+                try:
+                    os.close(os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+                writer.join(timeout=0.1)
+            shutil.rmtree(fifo_dir, ignore_errors=True)
+            for error in errors:
+                print(error)
+
+    def ingest(self, output_file, qc=True):
+        """
+        Streams the chunk files decompressed into output_file and computes their QC statistics on the way, every
+        chunk is read and decompressed exactly once. Reads that can't be parsed for QC (e.g. fasta) are still
+        streamed completely.
+        return: QCAccumulator of all reads or None if the reads couldn't be parsed (or qc is False)
+        """
+        qc_stream = QCStream(self.sample_name) if qc else None
+        with open(output_file, 'wb') as outfile:
+            for file_path in self.files:
+                opener = gzip.open if FastqConcatenator.is_gzipped(file_path) else open
+                with opener(file_path, 'rb') as infile:
+                    for block in iter(partial(infile.read, CHUNK_SIZE), b''):
+                        FastqConcatenator.write_bytes(outfile, block)
+                        qc_stream = self.write_qc(qc_stream, block)
+        statistics = self.write_qc(qc_stream, None)
+        print(f"Ingested {len(self.files)} files of {self.sample_name} into {output_file}"
+              f"{' with QC' if statistics is not None else ''}")
+        return statistics
+
+    def write_qc(self, qc_stream, block):
+        """
+        Writes a block to qc_stream or closes it if block is None.
+        return: qc_stream (the QCAccumulator after closing), None once the reads couldn't be parsed
+        """
+        if qc_stream is None:
+            return None
+        try:
+            if block is None:
+                return qc_stream.close()
+            qc_stream.write(block)
+            return qc_stream
+        except ValueError as e:
+            print(f"No QC statistics for {self.sample_name} from the ingest pass: {e}")
+            return None
@@ -0,0 +1,163 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from build_mmonitor_pyinstaller import ROOT
+
+# bump when the layout of cache entries changes, older entries are then never hit again
+STAGE_CACHE_VERSION = 1
+# number and size of the blocks read from every input file for the sampled content hash
+SAMPLE_BLOCKS = 8
+SAMPLE_BLOCK_SIZE = 64 * 1024
+
+
+class StageCache:
+    """
+    Content addressed cache for the results of pipeline stages (alignments, EM results, centrifuge output and
+    kraken reports). The key of a stage run is a hash of
+        - the input files: size, mtime and a hash of SAMPLE_BLOCKS evenly spaced blocks of every file
+        - the database version: size and mtime of the database files
+        - the stage parameters
+    so re-running a sample (e.g. with --overwrite) on unchanged reads, database and parameters skips the stage and
+    reuses the artifacts of the previous run. Cache entries live in pipeline_out/stage_cache/<stage>/<key>/, the
+    artifacts are hard linked into and out of the cache where possible, so a hit doesn't copy the data.
+    """
+
+    def __init__(self, cache_dir=None, enabled=True):
+        self.cache_dir = cache_dir or os.path.join(ROOT, "src", "resources", "pipeline_out", "stage_cache")
+        self.enabled = enabled
+
+    @staticmethod
+    def file_fingerprint(file_path):
+        """
+        Size, mtime and a hash of SAMPLE_BLOCKS blocks spread over the file (the whole file if it is small).
+        """
+        stat = os.stat(file_path)
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_path, 'rb') as infile:
+            if stat.st_size <= SAMPLE_BLOCKS * SAMPLE_BLOCK_SIZE:
+                digest.update(infile.read())
+            else:
+                step = (stat.st_size - SAMPLE_BLOCK_SIZE) // (SAMPLE_BLOCKS - 1)
+                for block in range(SAMPLE_BLOCKS):
+                    infile.seek(block * step)
+                    digest.update(infile.read(SAMPLE_BLOCK_SIZE))
+        return [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+    @staticmethod
+    def db_fingerprint(db_paths):
+        """
+        Size and mtime of all database files. db_paths are files, directories (all files directly inside) or glob
+        patterns (e.g. the centrifuge index prefix followed by .*.cf).
+        """
+        db_files = []
+        for db_path in db_paths:
+            if os.path.isdir(db_path):
+                db_files += [os.path.join(db_path, f) for f in os.listdir(db_path)]
+            else:
+                db_files += glob.glob(db_path)
+        fingerprint = []
+        for db_file in sorted(f for f in db_files if os.path.isfile(f)):
+            stat = os.stat(db_file)
+            fingerprint.append([os.path.basename(db_file), stat.st_size, stat.st_mtime_ns])
+        return fingerprint
+
+    def key(self, stage, input_files, db_paths=(), params=None):
+        """
+        param(str): stage name
+        param(list): input files, the order doesn't matter
+        param(list): database files, directories or glob patterns
+        param(dict): stage parameters, must be json serializable
+        return: hex key of the stage run
+        """
+        if isinstance(input_files, str):
+            input_files = [input_files]
+        content = {
+            "version": STAGE_CACHE_VERSION,
+            "stage": stage,
+            "inputs": sorted(self.file_fingerprint(f) for f in dict.fromkeys(input_files)),
+            "db": self.db_fingerprint(db_paths),
+            "params": params or {},
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def entry_dir(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key)
+
+    def restore(self, stage, key, outputs, label=""):
+        """
+        On a cache hit the artifacts of the entry are placed at the output paths. On a miss the existing output
+        paths are removed: hard links into the cache must not be truncated by the stage, and outputs of an earlier
+        run (or of a failed stage) must not be stored as results of this one.
+        param(dict): outputs artifact name -> output path
+        return: True on a hit, False on a miss
+        """
+        if not self.enabled:
+            return False
+        entry_dir = self.entry_dir(stage, key)
+        manifest_file = os.path.join(entry_dir, "manifest.json")
+        if not os.path.exists(manifest_file):
+            print(f"Stage cache miss for {stage} {label}({key[:12]})")
+            for output_path in outputs.values():
+                if os.path.isfile(output_path):
+                    os.remove(output_path)
+            return False
+        with open(manifest_file) as infile:
+            stored = json.load(infile)["artifacts"]
+        for name, output_path in outputs.items():
+            if name in stored:
+                self._link_or_copy(os.path.join(entry_dir, name), output_path)
+            elif os.path.exists(output_path):
+                # artifact was not produced in the cached run (e.g. no taxa above the threshold)
+                os.remove(output_path)
+        print(f"Stage cache hit for {stage} {label}({key[:12]}), reusing {', '.join(stored)}")
+        return True
+
+    def store(self, stage, key, outputs, optional=()):
+        """
+        Adds the existing output paths as artifacts of a new cache entry. The entry is written to a temporary
+        directory and renamed, so a crash never leaves a partial entry behind. No entry is stored if an artifact
+        that is not optional is missing, e.g. because the stage failed.
+        param(dict): outputs artifact name -> output path
+        param(iterable): names of artifacts a successful stage doesn't always produce
+        return: True if the entry was stored
+        """
+        if not self.enabled:
+            return False
+        missing = [name for name, output_path in outputs.items()
+                   if name not in optional and not os.path.exists(output_path)]
+        if missing:
+            print(f"Not caching {stage} ({key[:12]}), missing {', '.join(missing)}")
+            return False
+        entry_dir = self.entry_dir(stage, key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir), prefix=f".{key}.")
+        artifacts = []
+        for name, output_path in outputs.items():
+            if os.path.exists(output_path):
+                self._link_or_copy(output_path, os.path.join(tmp_dir, name))
+                artifacts.append(name)
+        with open(os.path.join(tmp_dir, "manifest.json"), 'w') as outfile:
+            json.dump({"stage": stage, "artifacts": artifacts}, outfile)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another process stored the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return True
+
+    @staticmethod
+    def _link_or_copy(src, dst):
+        if os.path.exists(dst):
+            if os.path.samefile(src, dst):
+                return
+            os.remove(dst)
+        os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
@@ -25,6 +25,7 @@ from tkcalendar import Calendar
 # from mmonitor.Tooltip import ToolTip
 from build_mmonitor_pyinstaller import ROOT, IMAGES_PATH
 from mmonitor.dashapp.index import Index
+from mmonitor.database import qc_encoding
 from mmonitor.database.DBConfigForm import DataBaseConfigForm
 from mmonitor.database.django_db_interface import DjangoDBInterface
 from mmonitor.database.mmonitor_db import MMonitorDBInterface
@@ -565,8 +566,7 @@ class GUI(ctk.CTk):
         fastq_stats = FastqStatistics(fastq_file)
 
         # Calculate statistics
-        fastq_stats.quality_statistics()
-        fastq_stats.read_lengths_statistics()
+        read_lengths_statistics = fastq_stats.read_lengths_statistics()
         quality_vs_lengths_data = fastq_stats.qualities_vs_lengths()
         gc_contents = fastq_stats.gc_content_per_sequence()
 
@@ -576,19 +576,22 @@ class GUI(ctk.CTk):
             'subproject_id': subproject_name,
             'date': sample_date,
             'mean_gc_content': fastq_stats.gc_content(),
-            'mean_read_length': np.mean(fastq_stats.lengths),
-            'median_read_length': np.median(fastq_stats.lengths),
-            'mean_quality_score': np.mean([np.mean(q) for q in fastq_stats.qualities]),
-            'read_lengths': json.dumps(quality_vs_lengths_data['read_lengths']),
-            'avg_qualities': json.dumps(quality_vs_lengths_data['avg_qualities']),
+            'mean_read_length': read_lengths_statistics.get('mean_length', 0),
+            'median_read_length': read_lengths_statistics.get('median_length', 0),
+            'mean_quality_score': fastq_stats.mean_read_quality(),
+            'read_lengths': qc_encoding.encode_samples(quality_vs_lengths_data['read_lengths']),
+            'avg_qualities': qc_encoding.encode_samples(quality_vs_lengths_data['avg_qualities']),
             'number_of_reads': fastq_stats.number_of_reads(),
             'total_bases_sequenced': fastq_stats.total_bases_sequenced(),
             'q20_score': fastq_stats.q20_q30_scores()[0],
             'q30_score': fastq_stats.q20_q30_scores()[1],
             # 'avg_quality_per_read': fastq_stats.quality_score_distribution()[0],
             # 'base_quality_avg': fastq_stats.quality_score_distribution()[1],
-            'gc_contents_per_sequence': json.dumps(gc_contents)
-
+            'gc_contents_per_sequence': qc_encoding.encode_samples(gc_contents),
+            'read_length_histogram': qc_encoding.encode_histogram(
+                qc_encoding.rebin(fastq_stats.read_length_histogram(), qc_encoding.READ_LENGTH_BIN_WIDTH),
+                width=qc_encoding.READ_LENGTH_BIN_WIDTH),
+            'gc_content_histogram': qc_encoding.encode_histogram(fastq_stats.gc_content_histogram(), start=-0.5),
         }
 
         self.django_db.send_sequencing_statistics(data)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the desktop app imports its modules relative to this directory (from lib import emu, from src.mmonitor...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
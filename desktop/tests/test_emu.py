@@ -0,0 +1,174 @@
+"""
+The optimized emu EM paths against their reference on synthetic data. Paths that are exact up to floating point
+rounding are compared with tight tolerances, approximate paths (quantized equivalence classes, pruning) with the
+tolerance they are documented to keep.
+"""
+import numpy as np
+import pytest
+
+from lib import emu
+
+DB_IDS = list(range(100, 130))
+
+
+def synthetic_log_p_rgs(n_reads=600, seed=0):
+    """
+    log(L(r|s)) of reads with 1-5 candidate species, scores are rounded so that reads share equivalence classes
+    """
+    rng = np.random.default_rng(seed)
+    abundance = rng.dirichlet(np.full(len(DB_IDS), .5))
+    log_p_rgs = {}
+    for read in range(n_reads):
+        true = rng.choice(len(DB_IDS), p=abundance)
+        others = [s for s in rng.choice(len(DB_IDS), rng.integers(0, 5), replace=False) if s != true]
+        log_l = [-10.0] + (-10.0 - np.round(rng.exponential(3, len(others)), 1)).tolist()
+        log_p_rgs[f"read{read}"] = ([DB_IDS[s] for s in [true] + others], log_l)
+    return log_p_rgs
+
+
+def synthetic_alignment_stats(n_reads, seed, offset=0, n_species=20):
+    """
+    AlignmentStats of reads with a primary and up to 5 secondary alignments, 5% of the reads are unmapped
+    """
+    rng = np.random.default_rng(seed)
+    rows, names = [], []
+    for read in range(n_reads):
+        names.append(f"read{offset + read}")
+        if rng.random() < .05:
+            rows.append((read, -1, 0, 0, 0, 0, 0, False))
+            continue
+        length = int(rng.normal(1450, 60))
+        true = rng.integers(n_species)
+        for rank, species in enumerate([true] + list(rng.choice(n_species, rng.integers(0, 6)))):
+            error = .06 if species == true else .06 + rng.exponential(.02)
+            insertions, deletions, mismatches = rng.poisson(length * error * np.array([.35, .35, .3]))
+            soft_clipped = rng.poisson(30)
+            rows.append((read, 1000 + species, insertions, deletions, soft_clipped, mismatches,
+                         length + insertions + deletions + soft_clipped, rank == 0))
+    stats = np.array(rows, dtype=np.int64)
+    return emu.AlignmentStats(query_names=names, query_idx=stats[:, 0], species_tid=stats[:, 1],
+                              cigar_stats=stats[:, 2:6], align_len=stats[:, 6], is_primary=stats[:, 7].astype(bool))
+
+
+def concat_alignment_stats(first, second):
+    return emu.AlignmentStats(query_names=first.query_names + second.query_names,
+                              query_idx=np.concatenate([first.query_idx, second.query_idx + len(first.query_names)]),
+                              **{field: np.concatenate([getattr(first, field), getattr(second, field)])
+                                 for field in emu.AlignmentStats._fields[2:]})
+
+
+def estimate(log_p_rgs, db_ids=DB_IDS, **kwargs):
+    freq, _, _ = emu.expectation_maximization_iterations(log_p_rgs, db_ids, 1e-6, 0, read_assignments=False,
+                                                         **kwargs)
+    return freq
+
+
+def assert_abundances_close(freq, freq_ref, atol):
+    total_variation, max_difference, n_differing = emu.abundance_delta(freq, freq_ref)
+    assert max_difference <= atol, (total_variation, max_difference)
+    assert n_differing == 0
+
+
+def test_csr_em_step_matches_dict_em_step():
+    log_p_rgs = synthetic_log_p_rgs()
+    matrix = emu.pack_log_p_rgs(log_p_rgs)
+    freq = dict(zip(DB_IDS, np.random.default_rng(1).dirichlet(np.ones(len(DB_IDS)))))
+    freq_vec = emu.freq_dict_to_vector(matrix, freq)
+    for _ in range(10):
+        freq_dict, log_likelihood_dict, p_sgr_dict = emu.expectation_maximization(log_p_rgs, freq)
+        freq_vec, log_likelihood_csr, p_sgr = emu.expectation_maximization_csr(matrix, freq_vec)
+        valid_species = freq_vec > 0
+        assert log_likelihood_csr == pytest.approx(log_likelihood_dict, rel=1e-12)
+        assert_abundances_close(emu.freq_vector_to_dict(matrix, freq_vec, valid_species), freq_dict, 1e-12)
+        p_sgr_csr = emu.p_sgr_to_dict(matrix, p_sgr, emu.freq_dict_to_vector(matrix, freq) > 0)
+        assert p_sgr_csr.keys() == p_sgr_dict.keys()
+        for tax_id, reads in p_sgr_dict.items():
+            assert p_sgr_csr[tax_id] == pytest.approx(reads, abs=1e-12)
+        freq = freq_dict
+
+
+def test_squarem_matches_plain_em():
+    log_p_rgs = synthetic_log_p_rgs()
+    # both stop once the log likelihood increases by less than 1e-6, not at the same point
+    assert_abundances_close(estimate(log_p_rgs, scheme='squarem'), estimate(log_p_rgs, scheme='plain'), 1e-5)
+
+
+def test_squarem_log_likelihood_never_decreases():
+    matrix = emu.pack_log_p_rgs(synthetic_log_p_rgs())
+    freq_vec = np.full(len(matrix.tax_ids), 1 / len(matrix.tax_ids))
+    log_likelihood = -np.inf
+    for _ in range(20):
+        freq_vec, updated_log_likelihood, _ = emu.squarem_iteration(matrix, freq_vec)
+        assert updated_log_likelihood >= log_likelihood - 1e-12 * abs(updated_log_likelihood)
+        log_likelihood = updated_log_likelihood
+
+
+def test_exact_equivalence_classes_match_reads():
+    log_p_rgs = synthetic_log_p_rgs()
+    matrix, _ = emu.compress_read_classes(emu.pack_log_p_rgs(log_p_rgs), 0)
+    assert len(matrix.read_names) < len(log_p_rgs)
+    assert matrix.weights.sum() == len(log_p_rgs)
+    assert_abundances_close(estimate(log_p_rgs, eq_class_tolerance=0), estimate(log_p_rgs), 1e-9)
+
+
+def test_quantized_equivalence_classes_stay_close():
+    # reads drawn from 20 multi-species templates with scores within +-tolerance/4 of the template, they only fall
+    # into shared classes after quantization
+    rng = np.random.default_rng(2)
+    templates = [(rng.choice(DB_IDS, 3, replace=False).tolist(), np.round(-10 - rng.exponential(2, 3), 1))
+                 for _ in range(20)]
+    log_p_rgs = {}
+    for read, template in enumerate(rng.integers(len(templates), size=600)):
+        tax_ids, log_l = templates[template]
+        jitter = rng.uniform(-emu.EQ_CLASS_TOLERANCE / 4, emu.EQ_CLASS_TOLERANCE / 4, len(log_l))
+        log_p_rgs[f"read{read}"] = (tax_ids, (log_l + jitter).tolist())
+    matrix = emu.pack_log_p_rgs(log_p_rgs)
+    assert len(emu.compress_read_classes(matrix, emu.EQ_CLASS_TOLERANCE)[0].read_names) < \
+        len(emu.compress_read_classes(matrix, 0)[0].read_names)
+    # a read is scored with the first read of its class, each score moves by less than the tolerance
+    assert_abundances_close(estimate(log_p_rgs, eq_class_tolerance=emu.EQ_CLASS_TOLERANCE), estimate(log_p_rgs),
+                            1e-3)
+
+
+def test_equivalence_classes_survive_hash_collisions(monkeypatch):
+    matrix = emu.pack_log_p_rgs(synthetic_log_p_rgs())
+    expected, _ = emu.compress_read_classes(matrix, 0)
+    # every read gets the same hash, only the comparison with the first read of a class keeps classes apart
+    monkeypatch.setattr(emu, "_mix64", lambda values: values * np.uint64(0))
+    collided, read_class = emu.compress_read_classes(matrix, 0)
+    assert collided.weights.sum() == len(matrix.read_names)
+    for read in range(len(matrix.read_names)):
+        entries = slice(matrix.indptr[read], matrix.indptr[read + 1])
+        class_entries = slice(collided.indptr[read_class[read]], collided.indptr[read_class[read] + 1])
+        assert sorted(zip(matrix.species_idx[entries], matrix.log_l[entries])) == \
+            sorted(zip(collided.species_idx[class_entries], collided.log_l[class_entries]))
+    assert len(collided.read_names) >= len(expected.read_names)
+
+
+def test_sharded_em_matches_single_process():
+    log_p_rgs = synthetic_log_p_rgs()
+    assert_abundances_close(estimate(log_p_rgs, em_workers=2), estimate(log_p_rgs), 1e-10)
+
+
+def test_pruning_only_drops_unlikely_candidates():
+    log_p_rgs = synthetic_log_p_rgs()
+    matrix = emu.pack_log_p_rgs(log_p_rgs)
+    pruned, n_pruned = emu.prune_read_candidates(matrix, 4.6)
+    assert len(pruned.log_l) == len(matrix.log_l) - n_pruned
+    assert len(pruned.read_names) == len(matrix.read_names)
+    # pruned candidates have at most 1% of the likelihood of the best candidate of their read
+    assert_abundances_close(estimate(log_p_rgs, prune_margin=4.6), estimate(log_p_rgs), 1e-3)
+
+
+def test_incremental_scores_match_full_rescore():
+    first = synthetic_alignment_stats(400, 1)
+    second = synthetic_alignment_stats(400, 2, offset=400)
+    db_ids = list(range(1000, 1020))
+
+    scores = None
+    for batch, all_stats in ((first, first), (second, concat_alignment_stats(first, second))):
+        scores = emu.update_incremental_scores(scores, batch)
+        matrix, unassigned_count, assigned_count = emu.incremental_read_matrix(scores)
+        full_matrix, full_unassigned_count, full_assigned_count = emu.log_prob_rgs_matrix(all_stats)
+        assert (assigned_count, unassigned_count) == (full_assigned_count, full_unassigned_count)
+        assert_abundances_close(estimate(matrix, db_ids), estimate(full_matrix, db_ids), 1e-9)
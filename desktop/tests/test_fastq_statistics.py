@@ -0,0 +1,63 @@
+"""
+QC statistics of a fastq file split into ranges (plain and bgzf) against the file read as a single range and
+against per-record parsing with Biopython.
+"""
+import numpy as np
+import pytest
+
+from src.mmonitor.userside import FastqStatistics as fastq_statistics
+
+ACCUMULATOR_FIELDS = ["length_histogram", "position_quality_sums", "quality_histogram", "gc_histogram"]
+
+
+def synthetic_fastq(n_reads=3000, seed=0):
+    """
+    Reads of random length with qualities from phred 0 to 40, so quality lines start with '@' and '+' as well
+    """
+    rng = np.random.default_rng(seed)
+    records = []
+    for read in range(n_reads):
+        length = int(rng.integers(1, 600))
+        sequence = rng.choice(np.frombuffer(b"ACGTN", dtype=np.uint8), length, p=[.24, .26, .26, .23, .01])
+        quality = rng.integers(33, 74, length, dtype=np.uint8)
+        records.append(b"@read%d length=%d\n%s\n+\n%s\n" % (read, length, sequence.tobytes(), quality.tobytes()))
+    return b"".join(records)
+
+
+@pytest.fixture(params=["plain", "bgzf"])
+def fastq_file(request, tmp_path):
+    data = synthetic_fastq()
+    if request.param == "plain":
+        file_path = tmp_path / "reads.fastq"
+        file_path.write_bytes(data)
+    else:
+        bgzf = pytest.importorskip("Bio.bgzf")
+        file_path = tmp_path / "reads.fastq.gz"
+        with bgzf.BgzfWriter(str(file_path), "wb") as writer:
+            writer.write(data)
+    return str(file_path)
+
+
+def test_ranges_match_whole_file(fastq_file, monkeypatch):
+    monkeypatch.setattr(fastq_statistics, "MIN_RANGE_SIZE", 4096)
+    ranges = fastq_statistics.fastq_ranges(fastq_file, 7)
+    assert len(ranges) > 1
+    merged = fastq_statistics.QCAccumulator()
+    for fastq_range in ranges:
+        merged.merge(fastq_statistics.process_fastq_range(fastq_range))
+    whole = fastq_statistics.process_fastq_file(fastq_file)
+
+    assert (merged.number_of_reads, merged.total_bases, merged.min_length, merged.max_length, merged.gc_bases) == \
+        (whole.number_of_reads, whole.total_bases, whole.min_length, whole.max_length, whole.gc_bases)
+    for field in ACCUMULATOR_FIELDS:
+        assert np.array_equal(getattr(merged, field), getattr(whole, field)), field
+    # summed in a different order
+    assert merged.read_quality_sum == pytest.approx(whole.read_quality_sum, rel=1e-12)
+
+
+def test_whole_file_matches_biopython(fastq_file):
+    pytest.importorskip("Bio.SeqIO")
+    accumulator = fastq_statistics.process_fastq_file(fastq_file)
+    assert (accumulator.number_of_reads, accumulator.total_bases, accumulator.gc_bases,
+            int(accumulator.quality_histogram[20:].sum()), int(accumulator.quality_histogram[30:].sum())) == \
+        fastq_statistics.seqio_statistics(fastq_file)
@@ -1,6 +1,5 @@
 import base64
 import io
-import json
 import re
 import sqlite3
 import tempfile
@@ -30,6 +29,7 @@ from statsmodels.nonparametric.smoothers_lowess import lowess
 
 from users.models import NanoporeRecord, Metadata
 from users.models import SequencingStatistics
+from users.qc_encoding import decode_array, decode_histogram
 from . import taxonomy, correlations, qc, diversity, horizon
 
 
@@ -1277,7 +1277,7 @@ TAXONOMY callbacks -----  Taxonomy callbacks ----- Taxonomy callbacks ----- Taxo
                                                                    sample_name=selected_sample).first()
 
             # Deserialize the avg_qualities field
-            avg_qualities = json.loads(stats_for_sample.avg_qualities)
+            avg_qualities = decode_array(stats_for_sample.avg_qualities)
 
             # Filter out the tail values based on z-score
             z_scores = zscore(avg_qualities)
@@ -1530,11 +1530,13 @@ TAXONOMY callbacks -----  Taxonomy callbacks ----- Taxonomy callbacks ----- Taxo
             stats_for_sample = SequencingStatistics.objects.filter(user_id=self.user_id,
                                                                    sample_name=selected_sample).first()
 
-            # Deserialize the read_lengths field
-            lengths = json.loads(stats_for_sample.read_lengths)
-
-            # Create the histogram
-            fig = go.Figure(data=[go.Histogram(x=lengths)])
+            # Use the read length histogram over all reads, samples stored without it only have the read lengths
+            edges, counts = decode_histogram(stats_for_sample.read_length_histogram)
+            if len(counts):
+                fig = go.Figure(data=[go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, width=np.diff(edges))])
+            else:
+                lengths = decode_array(stats_for_sample.read_lengths)
+                fig = go.Figure(data=[go.Histogram(x=lengths)])
             fig.update_layout(title="Read Length Distribution",
                               xaxis_title="Read Length",
                               yaxis_title="Frequency",
@@ -1554,13 +1556,13 @@ TAXONOMY callbacks -----  Taxonomy callbacks ----- Taxonomy callbacks ----- Taxo
             stats_for_sample = SequencingStatistics.objects.filter(user_id=self.user_id,
                                                                    sample_name=selected_sample).first()
 
-            # Deserialize the sequences field
-
-            # Compute GC content for each sequence
-            gc_contents = json.loads(stats_for_sample.gc_contents_per_sequence)
-
-            # Create the histogram
-            fig = go.Figure(data=[go.Histogram(x=gc_contents)])
+            # Use the gc content histogram over all reads, samples stored without it only have the gc contents
+            edges, counts = decode_histogram(stats_for_sample.gc_content_histogram)
+            if len(counts):
+                fig = go.Figure(data=[go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, width=np.diff(edges))])
+            else:
+                gc_contents = decode_array(stats_for_sample.gc_contents_per_sequence)
+                fig = go.Figure(data=[go.Histogram(x=gc_contents)])
             fig.update_layout(title="GC Content Distribution",
                               xaxis_title="GC Content (%)",
                               yaxis_title="Frequency",
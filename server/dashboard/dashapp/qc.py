@@ -1,4 +1,3 @@
-import json
 import random
 
 import dash_core_components as dcc
@@ -8,6 +7,7 @@ import plotly.graph_objs as go
 from django_plotly_dash import DjangoDash
 
 from users.models import SequencingStatistics
+from users.qc_encoding import decode_array
 
 
 class QC:
@@ -98,9 +98,9 @@ class QC:
             sample_name = sample['sample_name']
             project_id = sample['project_id']
             try:
-                # Convert string representation of list to actual list and convert each item to int
-                read_lengths_list = [int(length) for length in json.loads(sample['read_lengths'])]
-            except json.JSONDecodeError:
+                # Decode the stored read lengths (encoded array or json list) and convert each item to int
+                read_lengths_list = decode_array(sample['read_lengths']).astype(int).tolist()
+            except ValueError:
                 continue  # Skip samples with parsing errors
 
             # Downsample read lengths if there are more than sample_size read lengths
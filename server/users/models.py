@@ -68,8 +68,9 @@ class SequencingStatistics(models.Model):
     median_read_length = models.FloatField(null=True, blank=True)
     mean_quality_score = models.FloatField(null=True, blank=True)
     mean_gc_content = models.FloatField(null=True, blank=True)
-    read_lengths = models.TextField(null=True, blank=True)  # Serialized list of read lengths
-    avg_qualities = models.TextField(null=True, blank=True)  # Serialized list of average qualities per length
+    # per-read arrays and histograms are encoded with users.qc_encoding (json lists in older records)
+    read_lengths = models.TextField(null=True, blank=True)  # Encoded read lengths of a sample of reads
+    avg_qualities = models.TextField(null=True, blank=True)  # Encoded average qualities of a sample of reads
     number_of_reads = models.IntegerField(null=True, blank=True)
     total_bases_sequenced = models.IntegerField(null=True, blank=True)
     q20_score = models.FloatField(null=True, blank=True)
@@ -78,6 +79,8 @@ class SequencingStatistics(models.Model):
     base_quality_avg = models.TextField(null=True, blank=True)  # Serialized dictionary
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     gc_contents_per_sequence = models.TextField(null=True, blank=True)
+    read_length_histogram = models.TextField(null=True, blank=True)  # Encoded histogram of all read lengths
+    gc_content_histogram = models.TextField(null=True, blank=True)  # Encoded histogram of the gc content of all reads
 
     class Meta:
         verbose_name_plural = "Sequencing Statistics"
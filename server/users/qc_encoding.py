@@ -0,0 +1,130 @@
+"""
+Compact encoding of the per-read QC arrays and histograms of SequencingStatistics.
+
+The same module is used by the desktop client (desktop/src/mmonitor/database/qc_encoding.py) to encode and by the
+server to decode, keep both copies identical.
+
+An array is stored as text "<codec>:<dtype>:<base64 of the compressed little-endian array>", e.g. "zstd:<f4:KLUv...".
+codec is zstd if the zstandard package is available and zlib otherwise, decoding supports both. A histogram with fixed
+bins is stored as json {"start": first bin, "width": bin width, "counts": <encoded array>}. Values written before
+the encoding (json lists) are still decoded.
+"""
+import base64
+import json
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# per-read arrays are downsampled to at most this many values
+MAX_SAMPLES = 10_000
+# bin width of the read length histogram in bp
+READ_LENGTH_BIN_WIDTH = 50
+SAMPLE_DTYPE = "<f4"
+COUNT_DTYPE = "<i8"
+
+
+def _compress(data, codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    if codec == "zlib":
+        return zlib.compress(data, 9)
+    raise ValueError(f"Unknown QC array codec {codec}")
+
+
+def _decompress(data, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("QC array is zstd compressed but the zstandard package is not installed")
+        try:
+            return zstandard.ZstdDecompressor().decompress(data)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Invalid zstd QC array: {e}")
+    if codec == "zlib":
+        try:
+            return zlib.decompress(data)
+        except zlib.error as e:
+            raise ValueError(f"Invalid zlib QC array: {e}")
+    raise ValueError(f"Unknown QC array codec {codec}")
+
+
+def downsample(values, max_samples=MAX_SAMPLES, seed=0):
+    """
+    Random subset of at most max_samples values in their original order.
+    """
+    values = np.asarray(values)
+    if len(values) <= max_samples:
+        return values
+    keep = np.sort(np.random.default_rng(seed).choice(len(values), max_samples, replace=False))
+    return values[keep]
+
+
+def encode_array(values, dtype=SAMPLE_DTYPE, codec=None):
+    """
+    param(array-like): values
+    param(str): numpy dtype the values are stored as, little-endian
+    return: encoded text
+    """
+    codec = codec or ("zstd" if zstandard is not None else "zlib")
+    data = np.ascontiguousarray(values, dtype=np.dtype(dtype)).tobytes()
+    return f"{codec}:{dtype}:{base64.b64encode(_compress(data, codec)).decode('ascii')}"
+
+
+def decode_array(text):
+    """
+    return: numpy array of an encoded array or of a json list, empty if text is empty
+    raises: ValueError if text can't be decoded
+    """
+    if not text:
+        return np.array([], dtype=np.float32)
+    if text.lstrip().startswith("["):
+        return np.asarray(json.loads(text), dtype=np.float64)
+    try:
+        codec, dtype, payload = text.split(":", 2)
+    except ValueError:
+        raise ValueError(f"Invalid QC array {text[:20]}")
+    return np.frombuffer(_decompress(base64.b64decode(payload), codec), dtype=np.dtype(dtype))
+
+
+def encode_samples(values, max_samples=MAX_SAMPLES):
+    """
+    Downsampled per-read values (read lengths, mean qualities, gc contents) as float32.
+    """
+    return encode_array(downsample(values, max_samples), SAMPLE_DTYPE)
+
+
+def encode_histogram(counts, start=0, width=1):
+    """
+    param(array-like): number of values in every bin, bin i holds the values in
+                       [start + i * width, start + (i + 1) * width)
+    return: encoded text, trailing empty bins are dropped
+    """
+    counts = np.asarray(counts)
+    nonzero = np.nonzero(counts)[0]
+    counts = counts[:nonzero[-1] + 1] if len(nonzero) else counts[:0]
+    return json.dumps({"start": start, "width": width, "counts": encode_array(counts, COUNT_DTYPE)})
+
+
+def decode_histogram(text):
+    """
+    return: (bin edges, counts) like numpy.histogram, empty arrays if text is empty
+    """
+    if not text:
+        return np.array([]), np.array([], dtype=np.int64)
+    histogram = json.loads(text)
+    counts = decode_array(histogram["counts"])
+    return histogram["start"] + histogram["width"] * np.arange(len(counts) + 1), counts
+
+
+def rebin(counts, factor):
+    """
+    Adds up factor neighbouring bins of a histogram, e.g. to store 1 bp read length bins in 100 bp bins.
+    """
+    counts = np.asarray(counts)
+    padded = np.zeros(-(-len(counts) // factor) * factor, dtype=counts.dtype)
+    padded[:len(counts)] = counts
+    return padded.reshape(-1, factor).sum(axis=1)
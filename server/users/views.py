@@ -55,6 +55,8 @@ def add_sequencing_statistics(request):
                 base_quality_avg=json.dumps(data.get('base_quality_avg', {})),
                 gc_contents_per_sequence=data.get('gc_contents_per_sequence', "[]"),
                 # Default to empty list if not provided
+                read_length_histogram=data.get('read_length_histogram'),
+                gc_content_histogram=data.get('gc_content_histogram'),
 
                 user=user
             )